@@ -15,21 +15,119 @@ Not implemented move to GCP yet.
 
 import getopt, sys, os
 import argparse
+import asyncio
+import atexit
+import contextlib
+import csv
 import os
-import pandas as pd
+import importlib
+import importlib.util
 import logging
+import logging.handlers
 import hashlib
+import json
+import queue
+import select
+import struct
+import zlib
+import signal
+import socket
+import sqlite3
+import threading
+import time
 from pathlib import Path
-import numpy as np
+import concurrent.futures
 
 
 logger = logging.getLogger('app.' + __name__)
-pd.set_option('display.max_rows', 500)
-pd.set_option('display.max_columns', 500)
-pd.set_option('display.width', 1000)
-pd.options.mode.chained_assignment = None 
-
-def main():
+LOG_FORMAT = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s'
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S%z"
+#Pass as extra= to log lines written for every file, so --log-sample can bound them
+PER_FILE = {"per_file": True}
+#Per file lines of each message written before they are sampled
+LOG_SAMPLE = 1000
+#LogPipeline of the detailed log, set by setup_logging()
+log_pipeline = None
+#Read size used when hashing. 64 KiB reads could not keep up with the parallel filesystem,
+#4 MiB matches the Lustre RPC size and was the fastest in our benchmarks.
+MD5_BLOCKSIZE = 4 * 1024 * 1024
+FASTQ_GZ_EXTENSIONS = (".fastq.gz", ".fq.gz")
+#Illumina style FASTQ names, e.g. NY-MX12001-1_S1_L007_I1_001.fastq.gz
+FASTQ_FILENAME_PATTERN = (r"^(?P<aliquot>.+?)(?:_S(?P<sample_number>\d+))?_(?P<lane>L\d{3})"
+                          r"_(?P<read_type>[RI]\d)(?:_(?P<chunk>\d{3}))?\.(?:fastq|fq)(?:\.gz)?$")
+LANE_PATTERN = r"_(?P<lane>L\d{3})[_.]"
+EXTENSION_PATTERN = r"\.(?P<extension>[^.]+(?:\.gz)?)$"
+#Journal written by rename_files() so an interrupted rename can be resumed or rolled back
+RENAME_JOURNAL_NAME = ".qa_rename_journal.jsonl"
+PARSED_FILENAME_COLUMNS = ["aliquot", "sample_number", "lane", "read_type", "chunk", "extension"]
+READ_TYPES = ["R1", "R2", "R3", "I1", "I2"]
+#Lane of files without a lane in their name in the counts made by summarize_lanes()
+NO_LANE = ""
+TECHNIQUES_MASTER = "QC_techniques_master.csv"
+#Compiled techniques master, rebuilt when the master changes
+TECHNIQUE_RULES_CACHE = "QC_techniques_master.rules.json"
+#Version of the rules written by compile_technique_rules. Bump it when the compiler or the rules change shape,
+#caches of another version are rebuilt.
+TECHNIQUE_RULES_FORMAT = 2
+#file_format values of the techniques master that are FASTQ reads, and the read type in the file name
+FILE_FORMAT_KINDS = {"R1_fastq": "R1", "R2_fastq": "R2", "R3_fastq": "R3", "index1_fastq": "I1", "index2_fastq": "I2"}
+#Per file digests of the running checksum pass, read back by --resume. Named after the manifest,
+#so runs of different submissions started from the same directory do not share it.
+CHECKSUM_CHECKPOINT_NAME = "checksum_checkpoint_{name}_{key}.jsonl"
+#Entry of computed digests with the seconds it took to read the file. Not cached, it is not a digest.
+HASH_SECONDS = "seconds"
+#Byte value of a line end in decompressed FASTQ
+NEWLINE = ord("\n")
+#Seconds between fsyncs of the checksum checkpoint, lines are flushed as they are written
+CHECKPOINT_SYNC_INTERVAL = 5
+#inotify events used by --watch, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+#Seconds between directory scans when --watch can not use inotify
+WATCH_POLL_INTERVAL = 10
+
+class LazyModule:
+    """
+    Stand in for a module that is imported on first attribute access. pandas and numpy are most of
+    the start up time, and -h, option errors and resuming or rolling back a rename never need them.
+    """
+    def __init__(self, name, on_import=None):
+        self._name = name
+        self._on_import = on_import
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._on_import is not None:
+                self._on_import(module)
+            self._module = module
+        return getattr(self._module, attr)
+
+def configure_pandas(pandas):
+    pandas.set_option('display.max_rows', 500)
+    pandas.set_option('display.max_columns', 500)
+    pandas.set_option('display.width', 1000)
+    pandas.options.mode.chained_assignment = None 
+
+pd = LazyModule("pandas", configure_pandas)
+np = LazyModule("numpy")
+#Optional, only needed for --digests crc32c
+crc32c = LazyModule("crc32c")
+#Only needed for the log of --pool process workers
+multiprocessing = LazyModule("multiprocessing")
+#Only needed for --profile
+cProfile = LazyModule("cProfile")
+pstats = LazyModule("pstats")
+tracemalloc = LazyModule("tracemalloc")
+
+def build_parser():
+    """
+    Command line options. Also used by the QA service to turn a submitted job into options.
+    """
     ##User arguements
     parser = argparse.ArgumentParser( description='User inputs to QA script')
     parser.add_argument("-d", "--dir_path", dest="dir_path",help="Path to directory with files to be assessed", metavar="PATH")
@@ -37,12 +135,98 @@ def main():
     parser.add_argument("-t", "--technique", dest="technique",help="Technique to check files for")
     #Add option to direct logfile to a specific directory.
     parser.add_argument("-l", "--log", dest="log_dir",help="Full path where you would like to direct the detailed log file.", metavar="PATH")
+    parser.add_argument("--log-format", dest="log_format",help="Format of the detailed log: text, or json for one JSON object per line.", choices=["text", "json"], default="text")
+    parser.add_argument("--log-sample", dest="log_sample",help=f"Per file log lines of each kind (e.g. Computed md5 of ...) written in full, after that only one in every N is. 0 writes all of them. Default is {LOG_SAMPLE}.", type=int, default=LOG_SAMPLE, metavar="N")
     parser.add_argument("-s", "--skip", dest="skip",help="Flag to skip checksum tests. Only use for testing and checking technique assoc files", action='store_true')
     #Option for writing updated manifest to file
     parser.add_argument("-u", "--umanifest", dest="updated_man",help="Full path where you would like to direct the updated manifest file.", metavar="PATH")
     #Option to do renaming
     parser.add_argument("-r", "--rename", dest="rename",help="Flag to rename the files by adding flowcell name", action='store_true')
+    parser.add_argument("--recursive", dest="recursive",help="Flag to also look for the files in the manifest in subdirectories of -d. File names must be unique across subdirectories.", action='store_true')
+    parser.add_argument("--resume-rename", dest="resume_rename",help="Flag to finish an interrupted rename of the files in -d from its journal.", action='store_true')
+    parser.add_argument("--rollback-rename", dest="rollback_rename",help="Flag to undo the rename of the files in -d recorded in its journal.", action='store_true')
+    #Options for parallel checksum computation
+    parser.add_argument("-j", "--jobs", dest="jobs",help="Number of files to checksum in parallel. Default is 1 (serial).", type=int, default=1, metavar="N")
+    parser.add_argument("-b", "--block-size", dest="block_size",help="Read size in bytes used when computing checksums. Default is 4 MiB.", type=int, default=MD5_BLOCKSIZE, metavar="BYTES")
+    parser.add_argument("--pool", dest="pool",help="Worker pool used when --jobs > 1. Threads are fine for md5 as hashlib releases the GIL. async reads through a scheduler with per filesystem limits, read ahead and an optional bandwidth cap.", choices=["thread", "process", "async"], default="thread")
+    #Options for --pool async
+    parser.add_argument("--mount-jobs", dest="mount_jobs",help="With --pool async, files read at once per filesystem. Default is -j.", type=int, metavar="N")
+    parser.add_argument("--mount-limit", dest="mount_limits",help="With --pool async, files read at once on the filesystem mounted at MOUNT, e.g. /nfs/data=2. Can be given more than once.", action='append', default=[], metavar="MOUNT=N")
+    parser.add_argument("--read-ahead", dest="read_ahead",help="With --pool async, blocks read ahead of hashing per file. Default is 2.", type=int, default=2, metavar="N")
+    parser.add_argument("--max-read-mbps", dest="max_read_mbps",help="With --pool async, cap on the read rate of this QA run in MB/s. Default is no cap.", type=float, default=0, metavar="MBPS")
+    parser.add_argument("--validate-fastq", dest="validate_fastq",help="Flag to check gzip integrity and count FASTQ records of .fastq.gz files during the checksum read.", action='store_true')
+    parser.add_argument("--digests", dest="digests",help="Comma separated extra digests to compute in the same read as md5 (e.g. sha256,crc32c). Added as columns to the updated manifest.", default="", metavar="LIST")
+    parser.add_argument("--fail-fast", dest="fail_fast",help="Flag to stop before checksum QA if files are missing, empty or fail the technique and lane checks.", action='store_true')
+    #Options for the on-disk checksum cache
+    parser.add_argument("--cache", dest="cache_path",help="Full path to the checksum cache database. Default is checksum_cache.sqlite next to this script.", metavar="FILE")
+    parser.add_argument("--no-cache", dest="no_cache",help="Flag to compute every checksum without reading or writing the cache.", action='store_true')
+    parser.add_argument("--verify-cache", dest="verify_cache",help="Flag to recompute every checksum and report cached values that no longer match.", action='store_true')
+    parser.add_argument("--checkpoint", dest="checkpoint",help="File the digest of every file is appended to as soon as it is computed. Default is checksum_checkpoint_<manifest name>_<key>.jsonl in the working directory, keyed on the manifest path, which is deleted once every checksum is computed.", metavar="FILE")
+    parser.add_argument("--resume", dest="resume",help="Flag to continue an interrupted checksum run from its --checkpoint, skipping files that are done and unchanged.", action='store_true')
+    parser.add_argument("--cache-max-entries", dest="cache_max_entries",help="Maximum number of files kept in the checksum cache. Least recently used entries are evicted.", type=int, default=200000, metavar="N")
+    #Options for progress and metrics
+    parser.add_argument("--progress-interval", dest="progress_interval",help="Seconds between checksum progress lines with throughput and ETA. 0 turns them off. Default is 60.", type=float, default=60, metavar="SECONDS")
+    parser.add_argument("--metrics", dest="metrics",help="Write the time of every phase, bytes hashed, files/s and MB/s to FILE at the end of the run. Prometheus textfile format if FILE ends in .prom, JSON otherwise.", metavar="FILE")
+    parser.add_argument("--profile", dest="profile",help="Write cProfile stats and tracemalloc peak memory of every phase to this directory. Makes QA several times slower.", metavar="PATH")
+    #Options for the results history store
+    parser.add_argument("--history", dest="history_path",help="Full path to the SQLite store every run appends its results to. Default is qa_history.sqlite next to this script.", metavar="FILE")
+    parser.add_argument("--no-history", dest="no_history",help="Flag to not record the results of this run in the history store.", action='store_true')
+    #Options for running many submissions in one invocation
+    parser.add_argument("--batch", dest="batch",help="TSV of submissions to QA with columns dir_path, manifest_path and technique. Replaces -d, -m and -t.", metavar="FILE")
+    parser.add_argument("--batch-jobs", dest="batch_jobs",help="Number of submissions to QA at the same time in batch mode. -j is shared between them.", type=int, default=2, metavar="N")
+    parser.add_argument("--batch-out", dest="batch_out",help="Directory for per submission logs, results and the combined batch_summary.tsv. Default is batch_results.", default="batch_results", metavar="PATH")
+    #Options for the long running QA service
+    parser.add_argument("--serve", dest="serve",help="Run as a QA service accepting jobs on this Unix socket. --batch-jobs jobs run at a time and -j is shared between them. Outputs go to --batch-out.", metavar="SOCKET")
+    parser.add_argument("--submit", dest="submit",help="Send the QA job given by -d, -m, -t and the other options to the QA service on this Unix socket and print its results.", metavar="SOCKET")
+    #Options for watching a submission while it is uploaded
+    parser.add_argument("--watch", dest="watch",help="Flag to wait for the files in -d to land, hashing each one as soon as it is written, and run QA once all files in the manifest or the --done-file are there.", action='store_true')
+    parser.add_argument("--done-file", dest="done_file",help="Name of the marker file in -d that ends --watch even if files are missing.", metavar="NAME")
+    parser.add_argument("--watch-poll", dest="watch_poll",help="Poll -d every SECONDS instead of using inotify. Needed on NFS and Lustre when files are written from other hosts.", type=float, default=0, metavar="SECONDS")
+    parser.add_argument("--watch-timeout", dest="watch_timeout",help="Stop watching and run QA after SECONDS even if files are missing. Default is no limit.", type=float, default=0, metavar="SECONDS")
+    return parser
+
+def main():
+    parser = build_parser()
     options = parser.parse_args()
+    if options.block_size < 1:
+        parser.error(f"--block-size must be a positive number of bytes, got {options.block_size}")
+    for algorithm in parse_digests(options.digests):
+        try:
+            new_hasher(algorithm)
+        except ValueError as err:
+            parser.error(f"Unsupported digest {algorithm}: {err}")
+    try:
+        parse_mount_limits(options.mount_limits)
+    except ValueError:
+        parser.error(f"--mount-limit needs MOUNT=N, got {' '.join(options.mount_limits)}")
+    if options.resume_rename or options.rollback_rename:
+        if not options.dir_path or (options.resume_rename and options.rollback_rename):
+            parser.error("--resume-rename and --rollback-rename need -d and cannot be used together")
+        setup_logging(options.log_dir or Path(__file__).resolve().parent / "log.txt", options.log_format, options.log_sample)
+        if not resume_renames(rename_journal_path(options.dir_path), rollback=options.rollback_rename):
+            sys.exit(1)
+        return
+    if not (options.batch or options.serve) and not (options.dir_path and options.manifest_path and options.technique):
+        parser.error("-d, -m and -t are required unless --batch or --serve is used")
+    if options.resume and not (options.batch or options.serve or options.submit):
+        problem = ChecksumCheckpoint.resume_problem(checksum_checkpoint_path(options), options.manifest_path)
+        if problem:
+            parser.error(problem)
+    if options.submit:
+        if not submit_qa_job(options):
+            sys.exit(1)
+        return
+
+    #Techniques master is compiled once and shared by every submission in batch mode
+    script_dir = Path(__file__).resolve().parent
+    technique_rules = load_technique_rules(script_dir / TECHNIQUES_MASTER, script_dir / TECHNIQUE_RULES_CACHE)
+    if options.batch:
+        run_batch(options, technique_rules)
+        return
+    if options.serve:
+        setup_logging(options.log_dir or Path(__file__).resolve().parent / "log.txt", options.log_format, options.log_sample)
+        asyncio.run(serve_qa_jobs(options, technique_rules))
+        return
 
     #Logging setup and details
     parent_path = Path(__file__).resolve().parent
@@ -50,46 +234,317 @@ def main():
         log_path = options.log_dir
     else:
         log_path = parent_path / "log.txt"
-    logging.basicConfig(filename=log_path,
-                    filemode='w',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt="%Y-%m-%d %H:%M:%S%z",
-                    level=logging.DEBUG)
+    setup_logging(log_path, options.log_format, options.log_sample)
+    if options.watch:
+        precomputed = watch_submission(options, technique_rules)
+        run_qa(options, technique_rules, precomputed)
+    else:
+        run_qa(options, technique_rules)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues log records as they are, so messages are only formatted by the listener thread that
+    writes them and not on the thread that logged them.
+    """
+    def prepare(self, record):
+        return record
+
+class WorkerQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues log records of --pool process workers to the QA process. The message is formatted in the
+    worker, as its arguments may not pickle, and its template kept for PerFileLogSampler.
+    """
+    def prepare(self, record):
+        record.template = record.msg
+        return super().prepare(record)
+
+class PerFileLogSampler(logging.Filter):
+    """
+    Bounds the volume of per file log lines, records logged with extra=PER_FILE below WARNING.
+    The first limit lines of every message are written, then one in every limit. The others
+    are only counted and summarised when logging stops.
+    """
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.limit or record.levelno >= logging.WARNING or not getattr(record, "per_file", False):
+            return True
+        key = (record.name, getattr(record, "template", record.msg))
+        with self.lock:
+            count = self.counts[key] = self.counts.get(key, 0) + 1
+        return count <= self.limit or count % self.limit == 0
+
+    def suppressed(self):
+        """
+        Returns:
+        list: (logger name, message template, lines logged, lines not written) of sampled messages.
+        """
+        return [(name, template, count, count - self.limit - (count // self.limit - 1))
+                for (name, template), count in self.counts.items() if count > self.limit]
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per log line with the time, level, logger, thread and message of a record,
+    its exception if any and the fields passed with extra=.
+    """
+    RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "template"}
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, LOG_DATE_FORMAT), "level": record.levelname, "logger": record.name,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RECORD_FIELDS)
+        return json.dumps(entry, default=str)
+
+class LogPipeline:
+    """
+    The detailed log of a QA run. Loggers only put records on a queue, a listener thread formats
+    them, samples per file lines and writes them to the log file, so logging never waits on the file.
+    """
+    def __init__(self, log_path, log_format="text", sample=LOG_SAMPLE):
+        self.handler = logging.FileHandler(log_path, mode='w')
+        if log_format == "json":
+            self.handler.setFormatter(JsonLogFormatter())
+        else:
+            self.handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+        self.sampler = PerFileLogSampler(sample)
+        self.handler.addFilter(self.sampler)
+        self.queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, self.handler)
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+        root.addHandler(self.queue_handler)
+        root.setLevel(logging.DEBUG)
+        self.listener.start()
+
+    def listen_to_workers(self):
+        """
+        Start a listener writing the records --pool process workers put on its queue to the log.
+        Pass its queue to log_to_queue() in the workers and stop it once they are done.
+
+        Returns:
+        logging.handlers.QueueListener: The started listener.
+        """
+        listener = logging.handlers.QueueListener(multiprocessing.Queue(), self.handler)
+        listener.start()
+        return listener
+
+    def close(self):
+        """
+        Write the queued records and a summary of the sampled per file lines, then close the log file.
+        """
+        logging.getLogger().removeHandler(self.queue_handler)
+        self.listener.stop()
+        for name, template, count, suppressed in self.sampler.suppressed():
+            self.handler.handle(logging.makeLogRecord({
+                "name": name, "levelno": logging.INFO, "levelname": "INFO",
+                "msg": "%d of %d '%s' lines were not written (--log-sample %d)",
+                "args": (suppressed, count, template, self.sampler.limit)}))
+        self.handler.close()
+
+def log_to_queue(log_queue):
+    """
+    Initializer of --pool process workers, sends their log records to the QA process.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(WorkerQueueHandler(log_queue))
+    root.setLevel(logging.DEBUG)
+
+def setup_logging(log_path, log_format="text", sample=LOG_SAMPLE):
+    """
+    Send the detailed log to log_path, replacing any previous log handlers. Records are written
+    by a background thread, see LogPipeline.
+
+    Parameters:
+    log_path (str): Path of the log file, overwritten.
+    log_format (str): text, or json for one JSON object per line.
+    sample (int): Per file lines of each message written in full before only one in every sample is. 0 writes all.
+    """
+    global log_pipeline
+    stop_logging()
+    log_pipeline = LogPipeline(log_path, log_format, sample)
+
+def stop_logging():
+    """
+    Flush and close the detailed log. Run at exit, and by batch workers at the end of every submission.
+    """
+    global log_pipeline
+    if log_pipeline is not None:
+        log_pipeline.close()
+        log_pipeline = None
+
+atexit.register(stop_logging)
+
+def parse_mount_limits(mount_limits):
+    """
+    Per mount read limits from --mount-limit MOUNT=N options.
+
+    Returns:
+    dict: Mount path to number of files read at once.
+    """
+    limits = {}
+    for item in mount_limits or []:
+        mount, _, limit = item.rpartition("=")
+        limits[mount] = int(limit)
+    return limits
+
+def parse_digests(digests):
+    """
+    Turn the comma separated --digests option into a list of extra digests (md5 is always computed).
+    """
+    return [d.strip().lower() for d in digests.split(",") if d.strip() and d.strip().lower() != "md5"]
+
+def run_qa(options, technique_rules, precomputed=None):
+    """
+    Run QA for one submission, timing its phases and profiling them with --profile. The metrics are
+    written to --metrics and the results appended to the history store at the end, also when QA
+    stops with an error.
+
+    Parameters:
+    options (argparse.Namespace): Parsed command line options for the submission.
+    technique_rules (dict): Rules compiled from QC_techniques_master.csv by load_technique_rules().
+    precomputed (dict): Digests of files hashed by watch_submission(), see match_md5sums_to_manifest().
+
+    Returns:
+    tuple: (results table as pandas.DataFrame, True if QA passed else False)
+    """
+    profiler = StageProfiler(options.profile) if options.profile else None
+    metrics = RunMetrics(options.progress_interval, profiler)
+    status = "ERROR"
+    file_checks = None
+    results = {}
+    try:
+        file_checks, QA_flag = qa_submission(options, technique_rules, precomputed, metrics, results)
+        status = "PASSED" if QA_flag else "FAILED"
+        return file_checks, QA_flag
+    finally:
+        metrics.finish(status)
+        print(f"----{metrics.report()}----", flush=True)
+        logger.info(f"Metrics: {json.dumps(metrics.summary())}")
+        if options.metrics:
+            metrics.write(options.metrics)
+        if profiler is not None:
+            profiler.close()
+            print(f"Profile of every phase written to {options.profile}")
+        if not options.no_history:
+            try:
+                record_history(options.history_path or Path(__file__).resolve().parent / "qa_history.sqlite", options, status, metrics, file_checks, results)
+            except (sqlite3.Error, OSError):
+                logger.exception("Could not record the results in the history store.")
+
+def qa_submission(options, technique_rules, precomputed, metrics, results):
+    """
+    The QA steps of run_qa(), with the start of every phase marked in metrics. The manifest, checksum
+    results, file sizes and lane checks are added to results as they are made, for the history store.
+    """
+    parent_path = Path(__file__).resolve().parent
+    extra_digests = parse_digests(options.digests)
 
     #Read manifest file
+    metrics.start_phase("manifest")
     manifest = pd.read_csv(options.manifest_path, sep="\t")
+    #Parse aliquot, sample, lane, read type, chunk and extension out of the file names once.
+    manifest = manifest.join(parse_fastq_filenames(manifest['filename']))
+    results["manifest"] = manifest
     print("----Starting QA----")
-    #List all files in the directory provided
-    all_files = os.listdir(options.dir_path)
+    #List all files in the directory provided, and its subdirectories with --recursive
+    metrics.start_phase("reconcile")
+    locations, duplicates = scan_submission(options.dir_path, options.recursive)
 
     #Get matched and unmatched file names. Report if file in manifest not present in directory.
-    matched_files, unmatched_files, missingfiles_flag= check_dir_vs_manifest(all_files, manifest)
+    matched_files, unmatched_files, missingfiles_flag= check_dir_vs_manifest(list(locations), manifest, duplicates)
+    #Stat the matched files once, sizes, hashing and the checksum cache all use it
+    identities = stat_submission_files(options.dir_path, locations, matched_files, options.jobs)
+    results["sizes"] = {options.dir_path + locations[name]: identity[3] for name, identity in identities.items() if identity is not None}
 
     #Logging matches and mismatches
     logger.info(f"The number of matched files found: {len(matched_files)}")
     logger.info(f"The number of mismatched files found: {len(unmatched_files)}")
+    #Technique, lane and file size checks are cheap, run them before hashing.
+    ##Should be a loop for multiple techniques and aliquots???
+    #####
+    metrics.start_phase("technique_checks")
+    techniques = pd.read_csv(options.technique, sep=",")
+    file_list = get_technique_file_list(techniques, technique_rules)
+    results["lanes"] = []
+    file_checks = check_tech_assoc_files(manifest, file_list, techniques, unmatched_files, results["lanes"])
+    sizes_flag = check_file_sizes(options.dir_path, manifest, unmatched_files, identities)
+
+    #Stop before the expensive checksum pass if the submission already failed.
+    if options.fail_fast:
+        required_flag = not (file_checks['Required'] == "FAILED").any() if 'Required' in file_checks.columns else True
+        if not (missingfiles_flag and sizes_flag and required_flag):
+            logger.error("Structural checks failed. Stopping before checksum QA (--fail-fast).")
+            file_checks["MissingFiles"] = "PASSED" if missingfiles_flag else "FAILED"
+            file_checks["SizeQA"] = "PASSED" if sizes_flag else "FAILED"
+            file_checks["CheckSumQA"] = "NOT RUN"
+            print("*******************")
+            print("FINAL QA RESULTS")
+            print("*******************")
+            print(file_checks)
+            print("QA Failed before checksum QA (--fail-fast). Please check Table and log for details.")
+            return file_checks, False
+
     #generate md5sums
+    metrics.start_phase("checksum")
     md5sums_df = pd.DataFrame({"full_path": manifest.filename,"manifest_filename": manifest.filename,"manifest_checksum": manifest.checksum, "calculated_md5sum": ""})
-    md5sums_df['full_path'] = options.dir_path + md5sums_df['full_path'].astype(str)
+    md5sums_df['full_path'] = options.dir_path + md5sums_df['full_path'].astype(str).map(lambda name: locations.get(name, name))
 
     ###commented checksum checking to test technique
     if not options.skip:
         logger.info("Validating checksums now--")
         print("Performing checksum QA!!****")
         #flag for mismatched checksums
-        check_md5sums = match_md5sums_to_manifest(md5sums_df)
+        cache = None
+        if not options.no_cache:
+            cache_path = options.cache_path or parent_path / "checksum_cache.sqlite"
+            try:
+                cache = open_checksum_cache(cache_path)
+            except sqlite3.Error as err:
+                logger.warning("Checksum cache %s can not be used, computing every checksum: %s", cache_path, err)
+        checkpoint = ChecksumCheckpoint(checksum_checkpoint_path(options), options.manifest_path, options.resume)
+        scheduler = None
+        if options.pool == "async":
+            scheduler = ReadScheduler(options.jobs, options.mount_jobs, parse_mount_limits(options.mount_limits), options.read_ahead, options.max_read_mbps)
+        if options.resume:
+            logger.info(f"Resuming from {len(checkpoint.done)} checksums in {checkpoint.path}")
+            precomputed = {**checkpoint.done, **(precomputed or {})}
+        completed = False
+        try:
+            check_md5sums = match_md5sums_to_manifest(md5sums_df, options.jobs, options.pool, cache, options.verify_cache, options.block_size, ["md5"] + extra_digests + (["fastq"] if options.validate_fastq else []), precomputed, checkpoint,
+                                                      {options.dir_path + locations[name]: identity for name, identity in identities.items()}, scheduler, metrics)
+            completed = True
+        finally:
+            checkpoint.close()
+        #The default checkpoint is only needed to resume an interrupted checksum pass, a named --checkpoint is kept
+        if completed and not options.checkpoint:
+            checkpoint.remove()
+        if cache is not None:
+            try:
+                prune_checksum_cache(cache, options.cache_max_entries)
+            except sqlite3.Error as err:
+                logger.warning("Could not prune the checksum cache: %s", err)
+            cache.close()
+        results["checksums"] = md5sums_df
+        #Extra digests go into the updated manifest
+        for algorithm in extra_digests:
+            manifest[algorithm] = md5sums_df['calculated_' + algorithm]
     else:
         print("Skipping checksum QA!!!****")
         logger.info("Validating checksum step skipped!")
         check_md5sums = None
 
-    #check md5checksums
-    master_techniques = open_techniques_with_pathlib("QC_techniques_master.csv")
-    ##Should be a loop for multiple techniques and aliquots???
-    #####
-    file_list = get_technique_file_list(options.technique, master_techniques)
-    file_checks = check_tech_assoc_files(manifest, file_list, options.technique, unmatched_files)
-    
     #Check required files are present
     QA_flag = None
     #Log for overall printing
@@ -101,641 +556,1145 @@ def main():
         file_checks["CheckSumQA"] = "PASSED"
         logger.info(f"QA Passed")
         QA_flag = True
-        print(file_checks)
-        print("QA Passed. Please check Table for details.")
     elif missingfiles_flag == True and check_md5sums == None:
         file_checks["MissingFiles"] = "PASSED"
         file_checks["CheckSumQA"] = "SKIPPED"
         QA_flag = True
-        print(file_checks)
-        print("QA Passed. Please check Table for details.")
     elif missingfiles_flag == False and check_md5sums == None:
         file_checks["MissingFiles"] = "FAILED"
         file_checks["CheckSumQA"] = "SKIPPED"
         QA_flag = False
-        print(file_checks)
-        print("QA Failed. Please check Table for details.")
     else:
         file_checks["MissingFiles"] = "FAILED"
         file_checks["CheckSumQA"] = "FAILED"
         QA_flag = False
-        print(file_checks)
+    #Empty files and sizes that differ from the manifest fail QA, next to MissingFiles
+    file_checks.insert(file_checks.columns.get_loc("MissingFiles") + 1, "SizeQA", "PASSED" if sizes_flag else "FAILED")
+    if not sizes_flag:
+        QA_flag = False
+    #FASTQ validation results per aliquot, next to CheckSumQA
+    if options.validate_fastq and not options.skip:
+        fastq_ok = add_fastq_results(file_checks, md5sums_df, manifest)
+        if not fastq_ok and QA_flag == True:
+            logger.error("QA Failed FASTQ validation")
+            QA_flag = False
+    print(file_checks)
+    if QA_flag == True:
+        print("QA Passed. Please check Table for details.")
+    else:
         print("QA Failed. Please check Table for details.")
 
     #Renaming files below
-    updated_manifest, renaming_df = renaming_manifest_fastq(manifest, QA_flag, options.dir_path)
+    metrics.start_phase("rename_planning")
+    updated_manifest, renaming_df, info_renaming_df = renaming_manifest_fastq(manifest, QA_flag, options.dir_path)
+    if options.recursive:
+        renaming_df = nest_rename_paths(renaming_df, options.dir_path, locations)
+        info_renaming_df = nest_rename_paths(info_renaming_df, options.dir_path, locations)
     #fnx to rename the files
     if options.rename and QA_flag== True:
-        rename_files(renaming_df, 'filename', 'updated_filename')
+        #Info files listed as manifest rows keep the flowcell prefixed name from the N/O/P columns.
+        fastq_renaming_df = renaming_df[~renaming_df['filename'].isin(info_renaming_df['filename'])]
+        metrics.start_phase("rename")
+        renamed = rename_files(pd.concat([info_renaming_df, fastq_renaming_df]), 'filename', 'updated_filename', rename_journal_path(options.dir_path))
         #print(updated_manifest)
         #Write outputs
-        if options.updated_man:
+        metrics.start_phase("output")
+        if not renamed:
+            print("Files were not renamed, updated manifest not written.")
+        elif options.updated_man:
             updated_manifest.to_csv(options.updated_man, index=False, sep='\t')
         else:
             updated_manifest.to_csv('updated_manifest.txt', index=False, sep='\t')
         #for sanity check writing old and new filenames, maybe include in log file later.
         renaming_df.to_csv('updated_filenames.txt', index=False, sep='\t')
-    
-
+    return file_checks, QA_flag
 
-
-def split_column_based_on_aliquotname(df, column_to_split, column_with_delimiter):
+def read_batch_file(batch_path):
     """
-    Split a string in one column into two parts based on a delimiter specified in another column,
-    and place these parts into two separate new columns.
+    Read the list of submissions for batch mode. One submission per line with
+    tab separated dir_path, manifest_path and technique file. Blank lines,
+    lines starting with # and a dir_path header line are skipped.
 
     Parameters:
-    df (pandas.DataFrame): The DataFrame to modify.
-    column_to_split (str): The name of the column with strings to split.
-    column_with_delimiter (str): The name of the column with the delimiter.
+    batch_path (str): Path to the batch TSV.
 
     Returns:
-    pandas.DataFrame: The modified DataFrame with two new columns.
+    list of tuple: (dir_path, manifest_path, technique) with absolute paths.
     """
+    submissions = []
+    with open(batch_path) as batch_file:
+        for line in batch_file:
+            fields = line.rstrip("\n").split("\t")
+            if not fields[0].strip() or fields[0].startswith("#") or fields[0] == "dir_path":
+                continue
+            if len(fields) < 3:
+                raise ValueError(f"Batch line needs dir_path, manifest_path and technique: {line.strip()}")
+            dir_path, manifest_path, technique = (os.path.abspath(field.strip()) for field in fields[:3])
+            #Files are addressed as dir_path + filename, so keep the trailing /
+            submissions.append((os.path.join(dir_path, ""), manifest_path, technique))
+    return submissions
+
+def run_batch_submission(options, technique_rules, out_dir):
+    """
+    Run QA for one submission of a batch in its own output directory. The detailed
+    log, stdout, results table and updated manifest are written to out_dir.
 
-    # Check if the columns exist in the DataFrame
-    if column_to_split not in df.columns or column_with_delimiter not in df.columns:
-        raise ValueError("Specified columns not found in DataFrame")
-
-    # Initialize the new columns
-    df[column_to_split + '_Part1'] = None
-    df[column_to_split + '_Part2'] = None
-
-    # Perform the split and assign to new columns
-    for index, row in df.iterrows():
-        delimiter = str(row[column_with_delimiter])
-        # Split only on the first occurrence
-        parts = row[column_to_split].split(delimiter, 1)
-        df.at[index, column_to_split + '_Part1'] = parts[0]
-        df.at[index, column_to_split + '_Part2'] = parts[1] if len(parts) > 1 else ''
-
-    return df
+    Returns:
+    tuple: (results table as pandas.DataFrame or None, "PASSED", "FAILED" or "ERROR")
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    #Outputs of renaming_manifest_fastq are written to the working directory.
+    os.chdir(out_dir)
+    setup_logging(os.path.join(out_dir, "log.txt"), options.log_format, options.log_sample)
+    #Workers exit without running atexit, so the log is flushed here
+    with open(os.path.join(out_dir, "stdout.txt"), "w") as stdout_file, contextlib.redirect_stdout(stdout_file):
+        try:
+            file_checks, QA_flag = run_qa(options, technique_rules)
+        except Exception:
+            logger.exception("QA of %s failed with an error.", options.dir_path)
+            return None, "ERROR"
+        finally:
+            stop_logging()
+    file_checks.to_csv(os.path.join(out_dir, "results.tsv"), index=False, sep="\t")
+    return file_checks, "PASSED" if QA_flag else "FAILED"
+
+def run_batch(options, technique_rules):
+    """
+    QA every submission listed in options.batch with --batch-jobs submissions at a time,
+    sharing the loaded techniques master. -j is split between concurrent submissions.
+    Writes a combined batch_summary.tsv to options.batch_out.
+    """
+    submissions = read_batch_file(options.batch)
+    batch_out = os.path.abspath(options.batch_out)
+    os.makedirs(batch_out, exist_ok=True)
+    if options.cache_path:
+        options.cache_path = os.path.abspath(options.cache_path)
+    if options.history_path:
+        options.history_path = os.path.abspath(options.history_path)
+    running = max(1, min(options.batch_jobs, len(submissions)))
+    jobs_per_submission = max(1, options.jobs // running)
+    print(f"----Starting batch QA of {len(submissions)} submissions, {running} at a time----")
+
+    futures = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=running) as executor:
+        for number, (dir_path, manifest_path, technique) in enumerate(submissions, 1):
+            name = f"{number:04d}_{os.path.basename(os.path.dirname(dir_path))}"
+            submission_options = argparse.Namespace(**vars(options))
+            submission_options.dir_path = dir_path
+            submission_options.manifest_path = manifest_path
+            submission_options.technique = technique
+            submission_options.jobs = jobs_per_submission
+            #Read limits of --pool async are for the whole batch
+            if options.mount_jobs:
+                submission_options.mount_jobs = max(1, options.mount_jobs // running)
+            submission_options.max_read_mbps = options.max_read_mbps / running
+            submission_options.updated_man = None
+            #Every submission checkpoints to its own output directory
+            submission_options.checkpoint = None
+            if options.metrics:
+                submission_options.metrics = os.path.join(batch_out, name, os.path.basename(options.metrics))
+            if options.profile:
+                submission_options.profile = os.path.join(batch_out, name, "profile")
+            futures[name] = executor.submit(run_batch_submission, submission_options, technique_rules, os.path.join(batch_out, name))
+
+        summaries = []
+        for name, future in futures.items():
+            file_checks, status = future.result()
+            print(f"{name}: QA {status}")
+            if file_checks is None:
+                file_checks = pd.DataFrame([{}])
+            file_checks.insert(0, "Status", status)
+            file_checks.insert(0, "Submission", name)
+            summaries.append(file_checks)
+    summary = pd.concat(summaries, ignore_index=True)
+    summary.to_csv(os.path.join(batch_out, "batch_summary.tsv"), index=False, sep="\t")
+    print(summary)
+    print(f"Batch summary written to {os.path.join(batch_out, 'batch_summary.tsv')}")
+
+def warm_qa_worker():
+    """
+    Import pandas and numpy when a service worker starts, so the first job it runs does not pay for them.
+    """
+    pd.DataFrame
+    np.ndarray
 
+def absolute_job_paths(options):
+    """
+    Make the paths of a job absolute. Service workers run every job in its own output directory.
+    """
+    #Files are addressed as dir_path + filename, so keep the trailing /
+    options.dir_path = os.path.join(os.path.abspath(options.dir_path), "")
+    for option in ["manifest_path", "technique", "updated_man", "cache_path", "checkpoint", "metrics", "profile", "history_path"]:
+        if getattr(options, option):
+            setattr(options, option, os.path.abspath(getattr(options, option)))
+    return options
+
+def check_job_outputs(options, out_root):
+    """
+    Files a service job writes must stay in the service's --batch-out, clients cannot name other paths.
+    Call after absolute_job_paths().
 
-def prepend_string_to_column(df, column_name, string_to_prepend):
+    Raises:
+    ValueError: If an output option of the job points outside out_root.
     """
-    Prepend a string to all values in a specified column of a DataFrame.
+    root = os.path.realpath(out_root)
+    for option in ["updated_man", "cache_path", "checkpoint", "metrics", "profile", "history_path"]:
+        path = getattr(options, option)
+        if path and os.path.commonpath([root, os.path.realpath(path)]) != root:
+            raise ValueError(f"{option} {path} is outside the service output directory {out_root}")
 
-    Parameters:
-    df (pandas.DataFrame): The DataFrame to modify.
-    column_name (str): The name of the column to modify.
-    string_to_prepend (str): The string to prepend to each value in the column.
+async def serve_qa_jobs(options, technique_rules):
+    """
+    QA service. Accepts jobs on the Unix socket options.serve, one JSON line per connection
+    holding the options of the job (see submit_qa_job()), and answers with JSON line events:
+    queued when the job is accepted and finished with the status, stdout and results table.
+    Jobs run --batch-jobs at a time in worker processes that stay up between jobs, with the
+    technique rules kept loaded. Outputs of every job are written to their own directory in --batch-out.
+    Runs until SIGINT or SIGTERM.
+    """
+    #Another service may be listening on the socket, otherwise it is left over from a crash.
+    if os.path.exists(options.serve):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(options.serve)
+                raise SystemExit(f"A QA service is already listening on {options.serve}")
+            except ConnectionRefusedError:
+                os.remove(options.serve)
+    out_root = os.path.abspath(options.batch_out)
+    os.makedirs(out_root, exist_ok=True)
+    running = max(1, options.batch_jobs)
+    jobs_per_submission = max(1, options.jobs // running)
+    master_path = Path(__file__).resolve().parent / TECHNIQUES_MASTER
+    rules = {"mtime_ns": os.stat(master_path).st_mtime_ns, "rules": technique_rules}
+    counts = {"submitted": 0, "waiting": 0}
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=running, initializer=warm_qa_worker)
+    #Start the workers now so the first jobs do not wait for them
+    for _ in range(running):
+        executor.submit(os.getpid)
+
+    async def handle_job(reader, writer):
+        async def send(event):
+            writer.write((json.dumps(event) + "\n").encode())
+            await writer.drain()
+        try:
+            request = json.loads(await reader.readline())
+            defaults = vars(build_parser().parse_args([]))
+            job_options = argparse.Namespace(**{**defaults, **{k: v for k, v in request.get("options", {}).items() if k in defaults}})
+            if not (job_options.dir_path and job_options.manifest_path and job_options.technique):
+                raise ValueError("a job needs dir_path, manifest_path and technique")
+            if job_options.block_size < 1:
+                raise ValueError(f"block_size must be a positive number of bytes, got {job_options.block_size}")
+            absolute_job_paths(job_options)
+            check_job_outputs(job_options, out_root)
+        except (ValueError, TypeError, AttributeError) as err:
+            await send({"event": "error", "message": f"Bad job: {err}"})
+            writer.close()
+            return
+        job_options.jobs = jobs_per_submission
+        job_options.batch = job_options.serve = job_options.submit = None
+        #Pick up changes to the techniques master
+        mtime_ns = os.stat(master_path).st_mtime_ns
+        if mtime_ns != rules["mtime_ns"]:
+            rules["rules"] = load_technique_rules(master_path, master_path.parent / TECHNIQUE_RULES_CACHE)
+            rules["mtime_ns"] = mtime_ns
+            logger.info(f"Reloaded technique rules from {master_path}")
+        counts["submitted"] += 1
+        number = counts["submitted"]
+        out_dir = os.path.join(out_root, f"{number:06d}_{os.path.basename(os.path.dirname(job_options.dir_path))}")
+        logger.info(f"Job {number}: QA of {job_options.dir_path}, outputs in {out_dir}")
+        counts["waiting"] += 1
+        try:
+            await send({"event": "queued", "job": number, "waiting": counts["waiting"], "out_dir": out_dir})
+            file_checks, status = await loop.run_in_executor(executor, run_batch_submission, job_options, rules["rules"], out_dir)
+        except ConnectionError:
+            logger.warning(f"Job {number}: client disconnected before the job was queued")
+            return
+        except Exception:
+            logger.exception(f"Job {number}: QA worker failed")
+            file_checks, status = None, "ERROR"
+        finally:
+            counts["waiting"] -= 1
+        logger.info(f"Job {number}: QA {status}")
+        stdout_path = os.path.join(out_dir, "stdout.txt")
+        stdout = open(stdout_path).read() if os.path.exists(stdout_path) else ""
+        results = json.loads(file_checks.to_json(orient="records")) if file_checks is not None else []
+        try:
+            await send({"event": "finished", "job": number, "status": status, "out_dir": out_dir, "stdout": stdout, "results": results})
+        except ConnectionError:
+            logger.warning(f"Job {number}: client disconnected before the results were sent")
+        finally:
+            writer.close()
+
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    #Create the socket owner only, so no other user can connect between bind and chmod
+    umask = os.umask(0o077)
+    try:
+        server = await asyncio.start_unix_server(handle_job, path=options.serve)
+    finally:
+        os.umask(umask)
+    os.chmod(options.serve, 0o600)
+    print(f"----Serving QA jobs on {options.serve}, {running} at a time----", flush=True)
+    logger.info(f"Serving QA jobs on {options.serve}, {running} at a time, outputs in {out_root}")
+    async with server:
+        await stop.wait()
+    print("----Stopping QA service, waiting for running jobs----", flush=True)
+    await loop.run_in_executor(None, executor.shutdown)
+    with contextlib.suppress(OSError):
+        os.remove(options.serve)
+
+def submit_qa_job(options):
+    """
+    Send a QA job to the service on the Unix socket options.submit and print its output as it arrives.
 
     Returns:
-    pandas.DataFrame: The modified DataFrame with the string prepended.
+    bool: False if the service rejected the job or it failed with an error, True otherwise.
     """
+    job = absolute_job_paths(argparse.Namespace(**vars(options)))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(options.submit)
+        except OSError as err:
+            print(f"Could not connect to the QA service on {options.submit}: {err}")
+            return False
+        connection.sendall((json.dumps({"options": vars(job)}) + "\n").encode())
+        with connection.makefile() as events:
+            for line in events:
+                event = json.loads(line)
+                if event["event"] == "queued":
+                    print(f"----Queued as job {event['job']} ({event['waiting']} waiting or running), outputs in {event['out_dir']}----", flush=True)
+                elif event["event"] == "finished":
+                    print(event["stdout"], end="")
+                    if event["status"] == "ERROR":
+                        print(f"QA stopped with an error. Please check {os.path.join(event['out_dir'], 'log.txt')} for details.")
+                    return event["status"] != "ERROR"
+                else:
+                    print(event.get("message", line.strip()))
+                    return False
+    print("The QA service closed the connection before the job finished.")
+    return False
+
+class InotifyWatcher:
+    """
+    Paths relative to a directory of files closed after writing or moved into it, from Linux inotify.
+    With recursive=True subdirectories are watched too, also ones created while watching.
+    Raises OSError where inotify is not available.
+    """
+    def __init__(self, directory, recursive=False):
+        #ctypes is only needed in watch mode
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.directory = directory
+        self.recursive = recursive
+        #Watch descriptor to the subdirectory it watches, relative to directory
+        self.subdirs = {}
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self.add_watch("")
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_watch(self, subdir):
+        """
+        Watch subdir of the directory, and with recursive=True the subdirectories below it.
+
+        Returns:
+        list: Paths of the files already in the subdirectories below subdir, they may have landed before the watch.
+        """
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | (IN_CREATE if self.recursive else 0)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.directory, subdir)), mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), f"inotify_add_watch failed for {os.path.join(self.directory, subdir)}")
+        self.subdirs[wd] = subdir
+        found = []
+        if self.recursive:
+            with os.scandir(os.path.join(self.directory, subdir)) as entries:
+                for entry in entries:
+                    path = os.path.join(subdir, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        found += self.add_watch(path)
+                    elif subdir and entry.is_file():
+                        found.append(path)
+        return found
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for files to land.
+
+        Returns:
+        tuple: (list of file paths relative to the directory, True if events were lost and the directory must be rescanned)
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return [], False
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            overflow = overflow or bool(mask & IN_Q_OVERFLOW)
+            if not name or wd not in self.subdirs:
+                continue
+            path = os.path.join(self.subdirs[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                #A new subdirectory, files can land in it before it is watched
+                if self.recursive:
+                    try:
+                        names += self.add_watch(path)
+                    except OSError as err:
+                        logger.warning(f"Could not watch {os.path.join(self.directory, path)}: {err}")
+            elif not mask & IN_CREATE:
+                names.append(path)
+        return names, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Fallback for InotifyWatcher, also needed on NFS and Lustre where inotify does not see writes
+    made by other hosts. A file has landed once its size and mtime are unchanged for one interval.
+    """
+    def __init__(self, directory, interval, recursive=False):
+        self.directory = directory
+        self.interval = interval
+        self.recursive = recursive
+        self.seen = {}
+        self.reported = {}
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds (at most one interval) and return the files that settled, as InotifyWatcher.read().
+        """
+        time.sleep(min(timeout, self.interval))
+        current = {}
+        pending = [""]
+        while pending:
+            subdir = pending.pop()
+            with contextlib.suppress(OSError), os.scandir(os.path.join(self.directory, subdir)) as entries:
+                for entry in entries:
+                    with contextlib.suppress(OSError):
+                        if self.recursive and entry.is_dir(follow_symlinks=False):
+                            pending.append(os.path.join(subdir, entry.name))
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            current[os.path.join(subdir, entry.name)] = (stat.st_size, stat.st_mtime_ns)
+        settled = [name for name, signature in current.items()
+                   if self.seen.get(name) == signature and self.reported.get(name) != signature]
+        self.reported.update((name, current[name]) for name in settled)
+        self.seen = current
+        return settled, False
+
+    def close(self):
+        pass
+
+def open_watcher(directory, poll_interval, recursive=False):
+    """
+    InotifyWatcher for directory, or a PollingWatcher if poll_interval is set or inotify is not available.
+    """
+    if not poll_interval:
+        try:
+            return InotifyWatcher(directory, recursive)
+        except (OSError, AttributeError) as err:
+            logger.warning(f"inotify is not available ({err}), polling {directory} every {WATCH_POLL_INTERVAL} seconds")
+            poll_interval = WATCH_POLL_INTERVAL
+    return PollingWatcher(directory, poll_interval, recursive)
+
+def hash_landed_file(filepath, algorithms, blocksize):
+    """
+    Digests of a file that has landed together with its identity from file_identity().
 
-    # Check if the column exists in the DataFrame
-    if column_name not in df.columns:
-        raise ValueError(f"Column '{column_name}' not found in DataFrame")
-
-    # Prepend the string to each value in the column
-    df[column_name] = string_to_prepend + df[column_name].astype(str)
-
-    return df
+    Returns:
+    tuple: (identity, digests), or (None, None) if the file could not be read or changed while it was hashed.
+    """
+    identity = file_identity(filepath)
+    digests = compute_digests(filepath, algorithms, blocksize)
+    if identity is None or digests is None or file_identity(filepath) != identity:
+        return None, None
+    return identity, digests
 
-def check_R1_R2_fastq(lane_files, lane, missing_files):
+def check_landed_aliquot(manifest, file_list, techniques, aliquot, missing_files):
+    """
+    Lane checks of an aliquot whose files have all landed, ahead of the final QA.
     """
-    Check R1 and R2 files for raw techniques. It checks if the naming is 
-    consistent and required files are present.
+    aliquot_techniques = techniques[techniques['aliquot'] == aliquot]
+    checks = check_techniques(file_list, aliquot_techniques, summarize_lanes(manifest, missing_files))
+    for name, check_raw_files in zip(aliquot_techniques['name'], checks):
+        if check_raw_files is None:
+            continue
+        overall_opt, overall_req = check_QA_for_aliquot(check_raw_files)
+        print(f"All files of aliquot {aliquot} have landed. {name} lane checks: Required {overall_req}, Optional {overall_opt}", flush=True)
+
+def watch_submission(options, technique_rules):
+    """
+    Watch options.dir_path (and its subdirectories with --recursive) while the submission is uploaded. Files are hashed as soon as they are
+    closed after writing, and the lane checks of an aliquot run as soon as all of its files are there.
+
+    Stops when every file in the manifest has landed, the --done-file marker appears or --watch-timeout
+    passes. The final QA then only hashes files that changed since they landed.
 
     Parameters:
-    lane_files (pandas.DataFrame): DataFrame with files belonging to specific Lane.
-    lane (str): The name of the Lane for which files are being checked.
-    missing_files (str): DataFrame with missing files.
+    options (argparse.Namespace): Parsed command line options for the submission.
+    technique_rules (dict): Rules compiled from QC_techniques_master.csv by load_technique_rules().
 
     Returns:
-    pandas.DataFrame: Dataframe with results.
-    """
-    #check for R1 and R2 fastq files for raw techniques
-    #check if required files are present
-    required_files = pd.DataFrame()
-    #Lists with corresponding substrings
-    required = ["_R1", "_R2"]
-    #flag for capturing missing file
-    is_missing = True
-
-    for r in required:
-        checkr = lane_files[lane_files['filename'].str.contains(r)]
-        required_files = required_files.append(pd.DataFrame(data = checkr), ignore_index=True)
-        ext_req_checked = required_files[required_files['filename'].str.contains("fastq")]
-        if len(required_files) == 2 and len(ext_req_checked) !=2:
-            ext_req_checked = required_files[required_files['filename'].str.contains("fq")]
-    #Check if names being checked have been reported as missing
-    if ext_req_checked.loc[ext_req_checked['filename'].isin(missing_files)].empty:
-        is_missing = False
-    else:
-        is_missing = True
-    #Check if only one character is different. should it be ext_req_checked???
-    matches = match(ext_req_checked.filename[0],ext_req_checked.filename[1])
-    #add logic for checking if matched, else error
-    if matches and is_missing == False:
-        logger.info(f"In check_R1_R2_fastq(). Following files for lane: {lane} passed: %s ",",".join(ext_req_checked.filename))
-    elif matches and is_missing == True:
-        missed_names = ext_req_checked.loc[ext_req_checked['filename'].isin(missing_files)]
-        logger.error(f"In check_R1_R2_fastq(). Following files for lane: {lane} are missing: %s ",",".join(missed_names.filename))
-    else:
-        logger.error(f"In check_R1_R2_fastq(). Following files for lane: {lane} failed: %s ",",".join(ext_req_checked.filename))
-    return(ext_req_checked)
+    dict: Absolute file path to (identity, digests) of the landed files, for match_md5sums_to_manifest().
+    """
+    manifest = pd.read_csv(options.manifest_path, sep="\t")
+    manifest = manifest.join(parse_fastq_filenames(manifest['filename']))
+    manifest_files = set(manifest['filename'].astype(str))
+    techniques = pd.read_csv(options.technique, sep=",")
+    file_list = get_technique_file_list(techniques, technique_rules)
+    aliquot_index = build_aliquot_index(manifest)
+    aliquot_files = {aliquot: set(manifest.loc[rows, 'filename'].astype(str)) for aliquot, rows in aliquot_index.items()}
+    algorithms = ["md5"] + parse_digests(options.digests) + (["fastq"] if options.validate_fastq else [])
+
+    landed = {}
+    hashing = {}
+    checked_aliquots = set()
+    done_marker = False
+    deadline = time.monotonic() + options.watch_timeout if options.watch_timeout else None
+    #Watch before listing the directory, so files closed in between are not lost
+    watcher = open_watcher(options.dir_path, options.watch_poll, options.recursive)
+    polling = isinstance(watcher, PollingWatcher)
+    print(f"----Watching {options.dir_path} for {len(manifest_files)} files ({'polling' if polling else 'inotify'})----", flush=True)
+    executor = concurrent.futures.ThreadPoolExecutor(max(1, options.jobs))
+
+    def arrived(paths):
+        nonlocal done_marker
+        #Paths are relative to -d, files of the manifest can be in subdirectories with --recursive
+        for path in paths:
+            name = os.path.basename(path)
+            if path == options.done_file:
+                done_marker = True
+            elif name in manifest_files and not options.skip:
+                hashing[name] = executor.submit(hash_landed_file, options.dir_path + path, algorithms, options.block_size)
+            elif name in manifest_files:
+                landed[name] = None
+
+    def rescan():
+        #The polling watcher reports files already there once they are unchanged for one interval
+        if not polling:
+            arrived(scan_submission(options.dir_path, options.recursive)[0].values())
+        elif options.done_file and os.path.exists(options.dir_path + options.done_file):
+            arrived([options.done_file])
 
-def check_I1_I2_fastq(lane_files, lane, missing_files):
+    try:
+        rescan()
+        while True:
+            for name, future in list(hashing.items()):
+                if not future.done():
+                    continue
+                del hashing[name]
+                identity, digests = future.result()
+                if identity is None:
+                    #Still being written, it lands again when it is closed
+                    logger.info("%s changed while it was hashed, waiting for it to be closed again", name, extra=PER_FILE)
+                    continue
+                if name in landed:
+                    logger.info("%s was written again, hashed it again: %s", name, digests.get('md5'), extra=PER_FILE)
+                else:
+                    print(f"Landed {name} ({len(landed) + 1}/{len(manifest_files)})", flush=True)
+                    logger.info("Hashed %s as it landed: %s", name, digests.get('md5'), extra=PER_FILE)
+                landed[name] = (identity, digests)
+            #Lane checks of aliquots that are complete
+            missing_files = list(manifest_files - set(landed))
+            for aliquot, names in aliquot_files.items():
+                if aliquot not in checked_aliquots and names <= set(landed):
+                    checked_aliquots.add(aliquot)
+                    check_landed_aliquot(manifest, file_list, techniques, aliquot, missing_files)
+            if not hashing and (not missing_files or done_marker):
+                reason = "done marker found" if done_marker and missing_files else "all files landed"
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                reason = f"no complete submission after {options.watch_timeout} seconds"
+                break
+            names, overflow = watcher.read(0.2 if hashing else 1.0)
+            if overflow:
+                logger.warning(f"inotify events were lost, rescanning {options.dir_path}")
+                rescan()
+            arrived(names)
+    finally:
+        watcher.close()
+        for future in hashing.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+    print(f"----Stopped watching: {reason}, {len(landed)}/{len(manifest_files)} files landed----", flush=True)
+    logger.info(f"Stopped watching {options.dir_path}: {reason}")
+    return {value[0][0]: value for value in landed.values() if value is not None}
+
+def parse_fastq_filenames(filenames):
     """
-    Check I1 and I2 files for raw techniques. It checks if the naming is 
-    consistent and both sets of optional files are present.
+    Parse FASTQ file names into aliquot, sample number, lane, read type, chunk and extension
+    in one vectorized pass, so later checks compare columns instead of searching substrings.
 
     Parameters:
-    lane_files (pandas.DataFrame): DataFrame with files belonging to specific Lane.
-    lane (str): The name of the Lane for which files are being checked.
-    missing_files (str): DataFrame with missing files.
+    filenames (pandas.Series): File names from the manifest.
 
     Returns:
-    pandas.DataFrame: Dataframe with results.
-    """
-    #check for I1 and I2 fastq files for raw techniques
-    #check if optional files are present.If yes both have to present!
-    required_files = pd.DataFrame()
-    #List with corresponding substrings
-    required = ["_I1", "_I2"]
-    #flag for capturing missing file
-    is_missing = None
-
-    for r in required:
-        checkr = lane_files[lane_files['filename'].str.contains(r)]
-        required_files = required_files.append(pd.DataFrame(data = checkr), ignore_index=True)
-        ext_req_checked = required_files[required_files['filename'].str.contains("fastq")]
-        if len(required_files) == 2 and len(ext_req_checked) !=2:
-            ext_req_checked = required_files[required_files['filename'].str.contains("fq")]
-    #Check if only one character is different. should it be ext_req_checked???
-    if len(ext_req_checked) ==2:
-        matches = match(ext_req_checked.filename[0],ext_req_checked.filename[1])
-    else:
-        matches = False
-    #Check if names being checked have been reported as missing
-    if ext_req_checked.loc[ext_req_checked['filename'].isin(missing_files)].empty:
-        is_missing = False
-    else:
-        is_missing = True
-    #add logic for checking if matched, else error
-    if matches and is_missing == False:
-        logger.info(f"In check_I1_I2_fastq(). Following files for lane: {lane} passed: %s ",",".join(ext_req_checked.filename))
-    elif matches and is_missing == True:
-        missed_names = ext_req_checked.loc[ext_req_checked['filename'].isin(missing_files)]
-        logger.error(f"In check_I1_I2_fastq(). Following files for lane: {lane} are missing: %s ",",".join(missed_names.filename))
-    else:
-        logger.error(f"In check_I1_I2_fastq(). Following files for lane: {lane} failed file name QC: %s ",",".join(ext_req_checked.filename))
-    return(ext_req_checked)
-
-def check_R1_R2_R3_fastq(lane_files, lane):
+    pandas.DataFrame: One row per file name with the PARSED_FILENAME_COLUMNS. Except for
+    extension, columns are missing (NA) for file names that are not FASTQ files named in
+    the Illumina format.
     """
-    #Untested! No dataset. Deprioritized. Add check for missing_files.
-
-    Check R1, R2 and R3 files for raw techniques. It checks if the naming is 
-    consistent and required files are present.
+    filenames = filenames.astype(str)
+    parsed = filenames.str.extract(FASTQ_FILENAME_PATTERN)
+    parsed['extension'] = filenames.str.extract(EXTENSION_PATTERN)['extension']
+    #Lane of files that are not named like a read, e.g. nuc_hash files
+    parsed['lane'] = parsed['lane'].fillna(filenames.str.extract(LANE_PATTERN)['lane'])
+    parsed['sample_number'] = pd.to_numeric(parsed['sample_number']).astype('Int64')
+    return parsed[PARSED_FILENAME_COLUMNS]
+
+def summarize_lanes(manifest, missing_files):
+    """
+    Count the files of every (aliquot, lane) by kind and extension in one group-by pass.
+    These counts are all the technique checks need, so the manifest is not rescanned per lane.
 
     Parameters:
-    lane_files (pandas.DataFrame): DataFrame with files belonging to specific Lane.
-    lane (str): The name of the Lane for which files are being checked.
-    missing_files (str): DataFrame with missing files.
+    manifest (pandas.DataFrame): Manifest with the parsed file name columns.
+    missing_files (list): Files in the manifest that are missing from the directory.
 
     Returns:
-    pandas.DataFrame: Dataframe with results.
-    """
-    #check for R1, R2 and R3 fastq files for raw 5 file techniques
-    #check if required files are present
-    required_files = pd.DataFrame()
-    #Lists with corresponding substrings
-    required = ["_R1", "_R2", "_R3", "_I1"]
-
-    for r in required:
-        #Will need a more robust solution later as people name things inconsistently
-        checkr = lane_files[lane_files['filename'].str.contains(r)]
-        required_files = required_files.append(pd.DataFrame(data = checkr), ignore_index=True)
-        ext_req_checked = required_files[required_files['filename'].str.contains("fastq")]
-        if len(required_files) == 4 and len(ext_req_checked) !=4:
-            ext_req_checked = required_files[required_files['filename'].str.contains("fq")]
-    #Check if only one character is different. Adding second match for R3 files.
-    matches1 = match(ext_req_checked.filename[0],ext_req_checked.filename[1])
-    matches2 = match(ext_req_checked.filename[0],ext_req_checked.filename[2])
-    #add logic for checking if matched, else error
-    if matches1 and matches2:
-        logger.info(f"In check_R1_R2_R3_fastq(). Following files for lane: {lane} passed: %s ",",".join(ext_req_checked.filename))
-    else:
-        logger.error(f"In check_R1_R2_R3_fastq(). Following files for lane: {lane} failed: %s ",",".join(ext_req_checked.filename))
-    return(ext_req_checked)
-
-def check_R1_R2_nuchash_fastq(lane_files, lane):
+    pandas.DataFrame: Counts indexed by (aliquot, lane), aliquot as in aliquot_keys() and NO_LANE for files
+    without a lane. files is the number of files, <kind> the number of files of every kind from file_kinds(),
+    <kind>_fastq/<kind>_fq the number per extension and <kind>_missing, <kind>_fastq_missing and
+    <kind>_fq_missing how many of those are missing from the directory.
+    """
+    keys = aliquot_keys(manifest)
+    files = manifest[keys.notna()]
+    kinds = pd.get_dummies(file_kinds(files), dtype=int)
+    extension = files['extension'].fillna("")
+    fastq = extension.str.startswith("fastq")
+    fq = extension.str.startswith("fq")
+    missing = files['filename'].isin(missing_files)
+    counts = pd.concat([kinds,
+                        kinds.mul(fastq, axis=0).add_suffix('_fastq'),
+                        kinds.mul(fq, axis=0).add_suffix('_fq'),
+                        kinds.mul(missing, axis=0).add_suffix('_missing'),
+                        kinds.mul(fastq & missing, axis=0).add_suffix('_fastq_missing'),
+                        kinds.mul(fq & missing, axis=0).add_suffix('_fq_missing')], axis=1)
+    counts['files'] = 1
+    counts['aliquot'] = keys[files.index]
+    counts['lane'] = files['lane'].fillna(NO_LANE)
+    #More than one sample number or chunk in a lane means the names are not consistent
+    counts['sample_number'] = files['sample_number']
+    counts['chunk'] = files['chunk']
+    grouped = counts.groupby(['aliquot', 'lane'])
+    summary = grouped.sum(numeric_only=True).drop(columns=['sample_number', 'chunk'], errors='ignore')
+    summary['names'] = grouped[['sample_number', 'chunk']].nunique(dropna=False).max(axis=1)
+    return summary
+
+def file_kinds(manifest):
+    """
+    Kind of every file as named in the technique rules: nuc_hash for cell hashing files, the read
+    type (R1, I1, ...) for FASTQ files and otherwise the extension without .gz (bed, bim, fam, ...).
     """
-    #Untested! No dataset. Deprioritized. Add check for missing_files.
+    nuc_hash = manifest['filename'].astype(str).str.contains("nuc_hash", regex=False)
+    extension = manifest['extension'].str.lower().str.replace(r"\.gz$", "", regex=True)
+    return manifest['read_type'].fillna(extension).mask(nuc_hash, "nuc_hash")
 
-    Check R1, R2 files for nuchash techniques. It checks if the naming is 
-    consistent and required files are present.
+def aliquot_keys(manifest):
+    """
+    Aliquot of every manifest row. library_aliquot_name is used where present, otherwise the
+    aliquot parsed from the file name. Exact names, so NY-MX12001-1 never matches NY-MX12001-10.
+    """
+    keys = pd.Series(np.nan, index=manifest.index, dtype=object)
+    if 'library_aliquot_name' in manifest.columns:
+        keys = manifest['library_aliquot_name'].astype(object)
+    if 'aliquot' in manifest.columns:
+        keys = keys.fillna(manifest['aliquot'])
+    return keys
+
+def build_aliquot_index(manifest):
+    """
+    Index of manifest rows by aliquot, so each aliquot's files are a dictionary lookup
+    instead of a scan of the manifest.
 
     Parameters:
-    lane_files (pandas.DataFrame): DataFrame with files belonging to specific Lane.
-    lane (str): The name of the Lane for which files are being checked.
-    missing_files (str): DataFrame with missing files.
+    manifest (pandas.DataFrame): Manifest with the parsed file name columns.
 
     Returns:
-    pandas.DataFrame: Dataframe with results.
-    """
-    #check for R1, R2 and R3 fastq files for raw 5 file techniques
-    #check if required files are present
-    #incomplete. testing required.
-    required_files = pd.DataFrame()
-    #Lists with corresponding substrings
-    required = ["_R1", "_R2", "nuc_hash"]
-
-    for r in required:
-        #Will need a more robust solution later as people name things inconsistently
-        checkr = lane_files[lane_files['filename'].str.contains(r)]
-        required_files = required_files.append(pd.DataFrame(data = checkr), ignore_index=True)
-        ext_req_checked = required_files[required_files['filename'].str.contains("fastq")]
-        if len(required_files) == 3 and len(ext_req_checked) !=3:
-            ext_req_checked = required_files[required_files['filename'].str.contains("fq")]
-    #Check if only one character is different. Adding second match for R3 files.
-    matches1 = match(ext_req_checked.filename[0],ext_req_checked.filename[1])
-    #add logic for checking if matched, else error
-    if matches1:
-        logger.info(f"In check_R1_R2_nuchash_fastq(). Following files for lane: {lane} passed: %s ",",".join(ext_req_checked.filename))
-    else:
-        logger.error(f"In check_R1_R2_nuchash_fastq(). Following files for lane: {lane} failed: %s ",",".join(ext_req_checked.filename))
-    return(ext_req_checked)
-
-
-def check_I1_or_I2_fastq(lane_files, lane):
+    dict: Aliquot to the index labels of its manifest rows.
     """
-    #Untested! No dataset. Deprioritized. Add check for missing_files.
+    keys = aliquot_keys(manifest)
+    return keys.groupby(keys).groups
 
-    Check I1 or I2 files for 5 file submission techniques. It checks if the naming is 
-    consistent and required files are present.
-
-    Parameters:
-    lane_files (pandas.DataFrame): DataFrame with files belonging to specific Lane.
-    lane (str): The name of the Lane for which files are being checked.
-    missing_files (str): DataFrame with missing files.
+def parse_expected_lanes(value):
+    """
+    Lanes listed in the optional lanes column of the techniques file, e.g. "L001;L002", "1,2" or "1-4".
 
     Returns:
-    pandas.DataFrame: Dataframe with results.
+    list of str: Lane names like L001, or None if no lanes are listed.
     """
-    #check for I1 and I2 fastq files for raw techniques
-    #check if optional files are present.If yes both have to present!
-    required_files = pd.DataFrame()
-    
-    #List with corresponding substrings
-    required = ["_I1", "_I2"]
-
-    for r in required:
-        checkr = lane_files[lane_files['filename'].str.contains(r)]
-        required_files = required_files.append(pd.DataFrame(data = checkr), ignore_index=True)
-        ext_req_checked = required_files[required_files['filename'].str.contains("fastq")]
-        if len(ext_req_checked) ==0:
-            ext_req_checked = required_files[required_files['filename'].str.contains("fq")]
-    #Check if only one character is different. should it be ext_req_checked???
-    #If only one file
-    if len(ext_req_checked) == 1:
-        logger.info(f"In check_I1_or_I2_fastq(). Following lane: {lane} only has one Optional file: %s ",",".join(ext_req_checked.filename))
-    elif len(ext_req_checked) == 2:
-        matches = match(ext_req_checked.filename[0],ext_req_checked.filename[1])
-        #add logic for checking if matched, else error
-        if matches:
-            logger.info(f"In check_I1_or_I2_fastq(). Following files for lane: {lane} passed: %s ",",".join(ext_req_checked.filename))
+    if value is None or pd.isna(value) or not str(value).strip():
+        return None
+    lanes = []
+    for item in str(value).replace(",", ";").split(";"):
+        item = item.strip().upper().lstrip("L")
+        if not item:
+            continue
+        if "-" in item:
+            first, last = item.split("-", 1)
+            lanes.extend(f"L{lane:03d}" for lane in range(int(first), int(last.lstrip("L")) + 1))
         else:
-            logger.error(f"In check_I1_or_I2_fastq(). Following files for lane: {lane} failed: %s ",",".join(ext_req_checked.filename))
-    return(ext_req_checked)
+            lanes.append(f"L{int(item):03d}")
+    return lanes
 
+def kind_counts(lanes, kinds, suffix=""):
+    """
+    Columns <kind><suffix> of the lane counts as an array with one column per kind. Kinds without files are 0.
+    Plain arrays keep the per aliquot checks cheap, pandas overhead dominated them for small submissions.
+    """
+    columns = [lanes[kind + suffix].to_numpy(dtype=int) if kind + suffix in lanes.columns else np.zeros(len(lanes), dtype=int) for kind in kinds]
+    return np.column_stack(columns) if columns else np.zeros((len(lanes), 0), dtype=int)
 
-def check_raw_4_file_format_techniques(file_list, manifest, aliquot, missing_files):
-    """ This function checks for techniques that produce 4 files. 
-    These Files are expected to have specific substrings.
+def select_kind_files(lanes, kinds):
+    """
+    Number of files found and missing for a set of kinds in every lane.
+    For read types fastq files are used unless exactly one file per read type was found and they
+    are not all fastq, in which case fq files are used.
 
-    Parameters: 
-           1) List of expected files, 
-           2) Manifest for aliquot 
-           3) aliquot string (not using currently may want to later.
-           4) list of missing files.
+    Parameters:
+    lanes (pandas.DataFrame): Counts from summarize_lanes(), a row per lane or per aliquot.
+    kinds (list of str): Kinds of files, e.g. ["R1", "R2"] or ["bed", "bim", "fam"].
 
-    Output: DF with lane and T/F for required and optional files.
+    Returns:
+    tuple of numpy.ndarray: (selected files, selected files missing from the directory), a row per lane and a column per kind.
     """
-    #ASSUMPTION! Every aliquot has 8 lanes that will be named in rthe format below. 
-    #Confirmed assumption with Suvvi on 10/19.
-
-    #Lanes per aliquot
-    lanes_substring = ["L001","L002","L003","L004","L005","L006","L007","L008"]
-    logger.debug("In check_raw_4_file_format_techniques()")
-    #Capture per lane file checks
-    lane_checks = []
+    selected = kind_counts(lanes, kinds)
+    missing = kind_counts(lanes, kinds, "_missing")
+    reads = [column for column, kind in enumerate(kinds) if kind in READ_TYPES]
+    if reads:
+        read_kinds = [kinds[column] for column in reads]
+        found = selected[:, reads].sum(axis=1)
+        fastq = kind_counts(lanes, read_kinds, "_fastq")
+        use_fq = ((found == len(reads)) & (fastq.sum(axis=1) != len(reads)))[:, None]
+        selected[:, reads] = np.where(use_fq, kind_counts(lanes, read_kinds, "_fq"), fastq)
+        missing[:, reads] = np.where(use_fq, kind_counts(lanes, read_kinds, "_fq_missing"), kind_counts(lanes, read_kinds, "_fastq_missing"))
+    return selected, missing
+
+def evaluate_technique_rules(rules, lanes):
+    """
+    Check lane counts against the compiled rules of a technique, for every row at once.
+    Raw data is checked per lane: every required kind needs exactly one file that is not missing,
+    optional kinds are all there or all absent, and a lane may not have files of other kinds.
+    Other data (e.g. gwas bed/bim/fam) is checked per aliquot: every required kind needs a file that is not missing.
 
-    #For every aliquot there should be at least R1 and R2 for each lane.
-    for lane in lanes_substring:
-        #print(lane)
-        req = None
-        opt = None
-        lane_files = manifest[manifest['filename'].str.contains(lane)]
-        #Add check to see if the filenames being checked exist in the directory
-        row = []
-        row.append(lane)
-        #Flags to check for missing files
-        req_in_dir = None
-        opt_in_dir = None
-        #If # files == 4, check for R1/2 and I1/2
-        if len(lane_files) ==4 or len(lane_files) ==3:
-            #check if required files are present
-            required_files = check_R1_R2_fastq(lane_files, lane, missing_files)
-            if required_files.loc[required_files['filename'].isin(missing_files)].empty:
-                req_in_dir = False
-            else:
-                req_in_dir = True
-            if len(required_files) == 2 and req_in_dir == False:
-                req = True
-                row.append(req)
-            else:
-                req = False
-                row.append(req)
-            optional_files = check_I1_I2_fastq(lane_files, lane, missing_files)
-            if optional_files.loc[optional_files['filename'].isin(missing_files)].empty:
-                opt_in_dir = False
-            else:
-                opt_in_dir = True
-            if len(optional_files) == 2 and opt_in_dir == False:
-                opt = True
-                row.append(opt)
-            else:
-                opt = False
-                row.append(opt)
-            ##check to see if all 4 iles are present and if not, fail flags
-            if len(optional_files) == 2 and len(required_files) == 2:
-                opt = True
-                req = True
-            elif len(required_files) == 2 and len(optional_files) == 1:
-                opt = False
-                req = True
-            else:
-                opt = False
-                req = False
-        #If # files == 2, check for R1/2 
-        elif len(lane_files) ==2:
-            required_files = check_R1_R2_fastq(lane_files, lane, missing_files)
-            if len(required_files) == 2:
-                req = True
-                row.append(req)
-            else:
-                row.append(opt)
-        #account for missing lanes, they dont always submit all lanes.
-        elif len(lane_files) == 0:
-            logger.warning(f"No files were found for lane {lane} in aliquot {aliquot}")
-            row.append(req)
-            row.append(opt)
-        #If # files anything else error
-        else:
-            logger.error(f"Mismatch found! Please check file names for aliquot: {aliquot}")
-            row.append(req)
-            row.append(opt)
-        lane_checks.append(row)
-    return(pd.DataFrame(lane_checks, columns = ["Lane", "Req", "Opt"]))
+    Parameters:
+    rules (dict): Rules of the technique from compile_technique_rules().
+    lanes (pandas.DataFrame): Counts from summarize_lanes(), a row per lane for raw data and per aliquot otherwise.
 
-def check_raw_3_hash_file_format_techniques(file_list, manifest, aliquot_files, missing_files):
-    """ 
-    This function checks for techniques that produce 5 files. 
-    These Files are expected to have specific substrings.
-    Input: 1) List of expected files, 
-           2) Manifest for aliquot 
-           3) aliquot string (not using currently may want to later.
-           4) list of missing files.
-    Output: DF with lane and T/F for required and optional files.
-    """
-    #ASSUMPTION! Every aliquot has 8 lanes that will be named in the format below. Confirmed assumption with Suvvi on 10/19.
-    lanes_substring = ["L001","L002","L003","L004","L005","L006","L007","L008"]
-    print(" in sub for 3 files")
-    #params for nuc_hash
-    required = ["R1", "R2"]
-    format = ["fastq", "fq"]
-    # For every aliquot there should be at least R1 and R2
-    #req = '|'.join(r"\b{}\b".format(x) for x in required)
-    for lane in lanes_substring:
-        print(lane)
-        lane_files = manifest[manifest['filename'].str.contains(lane)]
-        #If # files == 4, check for R1/2 and I1/2
-        if len(lane_files) ==3:
-            #check if required files are present
-            required_files = check_R1_R2_fastq(lane_files, lane)
-            required_hash = "set up params"
-        #If # files == 4, check for R1/2 
-        elif len(lane_files) ==2:
-            required_files = check_R1_R2_fastq(lane_files, lane)
-        elif len(lane_files) == 0:
-            logger.warning(f"No files were found for lane {lane} in aliquot {aliquot}")
-        #If # files anything else error
-        else:
-            print("Mismatched # of files found")
-        #check if both files are present and have the right extention
-    return("yes")
-
-def check_raw_5_file_format_techniques(file_list, manifest, aliquot, missing_files):
-    """ This function checks for techniques that produce 5 files. 
-    These Files are expected to have specific substrings.
-    Input: 1) List of expected files, 
-           2) Manifest for aliquot 
-           3) aliquot string (not using currently may want to later.
-           4) list of missing files.
-    Output: DF with lane and T/F for required and optional files.
-    """
-    #ASSUMPTION! Every aliquot has lanes that will be named in the format below. Confirmed assumption with Suvvi on 10/19.
-    lanes_substring = ["L001","L002","L003","L004","L005","L006","L007","L008"]
-    format = ["fastq", "fq"]
-    #Capture per lane file checks
-    lane_checks = []
-
-    # For every aliquot there should be at least R1 and R2
-    for lane in lanes_substring:
-        req = False
-        opt = False
-        logger.debug("In check_raw_5_file_format_techniques().")
-        lane_files = manifest[manifest['filename'].str.contains(lane)]
-        row = []
-        row.append(lane)
-        #If # files == 5, check for R1/2/3 and I1/2
-        if len(lane_files) == 4 or len(lane_files) == 5:
-            #check if required files are present
-            required_files = check_R1_R2_R3_fastq(lane_files, lane)
-            if len(required_files) == 4:
-                req = True
-                row.append(req)
-        elif len(lane_files) == 0:
-            logger.warning(f"No files were found for lane {lane} in aliquot {aliquot}")
-            row.append(req)
-            row.append(opt)
-        #If # files anything else error
-        else:
-            #print("Mismatched # of files found")
-            logger.error(f"Mismatch found! Please check file names for aliquot: {aliquot}")
-            row.append(req)
-            row.append(opt)
-        lane_checks.append(row)
-        #check if both files are present and have the right extention
-    print("Performed checks for aliquot: ", aliquot)
-    return(pd.DataFrame(lane_checks, columns = ["Lane", "Req"]))
+    Returns:
+    tuple of numpy.ndarray: (Req, Opt, number of files of other kinds) for every row. Opt is None where no optional files were found.
+    """
+    required, required_missing = select_kind_files(lanes, rules["required"])
+    optional, optional_missing = select_kind_files(lanes, rules["optional"])
+    files = lanes['files'].to_numpy(dtype=int)
+    if rules["per_lane"]:
+        required_ok = (required == 1).all(axis=1)
+        optional_ok = (optional == 1).all(axis=1)
+        #Files of kinds the technique does not have
+        other = files - kind_counts(lanes, rules["required"] + rules["optional"]).sum(axis=1)
+    else:
+        required_ok = (required > 0).all(axis=1)
+        optional_ok = (optional > 0).all(axis=1)
+        other = np.zeros(len(lanes), dtype=int)
+    required_ok &= (required_missing == 0).all(axis=1) & (other == 0) & (files > 0)
+    optional_ok &= (optional_missing == 0).all(axis=1)
+    opt = np.where(kind_counts(lanes, rules["optional"]).sum(axis=1) == 0, None, optional_ok.astype(object))
+    return required_ok.astype(object), opt, other
+
+def check_techniques(file_list, techniques, lane_summary):
+    """
+    Check the files of every row of the techniques file. The lanes of all aliquots of a technique
+    are checked together by evaluate_technique_rules(), so the cost does not grow with a pandas
+    pass per aliquot. Only failures are logged.
 
+    Parameters:
+    file_list (dict): Technique rules from get_technique_file_list().
+    techniques (pandas.DataFrame): Techniques file with name, aliquot and an optional lanes column
+        listing lanes that must be present on top of the lanes found in the file names.
+    lane_summary (pandas.DataFrame): Counts by aliquot and lane from summarize_lanes().
 
-def check_tech_assoc_files(manifest, file_list, techniques, missing_files):
+    Returns:
+    list of dict: For every row of techniques, Lane and T/F for required (Req) and optional (Opt) files as lists,
+    or None if the technique has no rules. An aliquot without any lanes gets a single failed row so it can not pass QA without files.
+    """
+    names = techniques['name'].tolist()
+    aliquots = techniques['aliquot'].tolist()
+    expected = [parse_expected_lanes(value) for value in techniques['lanes']] if 'lanes' in techniques.columns else [None] * len(techniques)
+    found_lanes = {}
+    for aliquot, lane in lane_summary.index:
+        if lane != NO_LANE:
+            found_lanes.setdefault(aliquot, []).append(lane)
+    rows_by_technique = {}
+    for position, name in enumerate(names):
+        if name in file_list:
+            rows_by_technique.setdefault(name, []).append(position)
+
+    tables = [None] * len(techniques)
+    for name, positions in rows_by_technique.items():
+        rules = file_list[name]
+        if rules["per_lane"]:
+            keys = []
+            owners = []
+            for position in positions:
+                lanes = sorted(set(found_lanes.get(aliquots[position], [])) | set(expected[position] or []))
+                keys.extend((aliquots[position], lane) for lane in lanes)
+                owners.extend([position] * len(lanes))
+            index = pd.MultiIndex.from_tuples(keys, names=lane_summary.index.names) if keys else lane_summary.index[:0]
+            lanes = lane_summary.reindex(index, fill_value=0)
+            lane_names = [lane for _, lane in keys]
+        else:
+            lanes = lane_summary.groupby(level='aliquot').sum().reindex([aliquots[position] for position in positions], fill_value=0)
+            owners = positions
+            lane_names = [None] * len(positions)
+        req, opt, other = evaluate_technique_rules(rules, lanes)
+        files = lanes['files'].to_numpy(dtype=int)
+        names_per_lane = lanes['names'].to_numpy(dtype=int)
+        for row in np.flatnonzero((req == False) | (opt == False) | (rules["per_lane"] & ((files == 0) | (names_per_lane > 1)))):
+            lane, aliquot = lane_names[row], aliquots[owners[row]]
+            if rules["per_lane"] and files[row] == 0:
+                logger.error("No files were found for expected lane %s in aliquot %s", lane, aliquot)
+            if rules["per_lane"] and names_per_lane[row] > 1:
+                logger.error("Files for lane: %s of aliquot %s failed file name QC. More than one sample number or chunk found.", lane, aliquot)
+            if other[row] > 0:
+                logger.error("Lane %s of aliquot %s has files that are not part of the technique.", lane, aliquot)
+            if req[row] == False or opt[row] == False:
+                logger.error("Files for lane: %s of aliquot %s failed. Required/Optional files are missing or incomplete.", lane, aliquot)
+        for row, position in enumerate(owners):
+            if tables[position] is None:
+                tables[position] = {"Lane": [], "Req": [], "Opt": []}
+            tables[position]["Lane"].append(lane_names[row])
+            tables[position]["Req"].append(req[row])
+            tables[position]["Opt"].append(opt[row])
+        for position in positions:
+            if tables[position] is None:
+                logger.error("No lanes were found in the file names for aliquot %s", aliquots[position])
+                tables[position] = {"Lane": [None], "Req": [False], "Opt": [None]}
+    return tables
+
+def format_lane_results(table):
+    """
+    The Lane/Req/Opt table of check_techniques() as pandas prints it, without building a DataFrame
+    per aliquot. Printing DataFrames was most of the time of the technique checks.
+    """
+    index = [str(row) for row in range(len(table["Lane"]))]
+    index_width = max(len(label) for label in index)
+    columns = [[str(value) for value in table[column]] for column in table]
+    widths = [max([len(column)] + [len(value) for value in values]) for column, values in zip(table, columns)]
+    lines = [" " * index_width + "".join("  " + column.rjust(width) for column, width in zip(table, widths))]
+    for row, label in enumerate(index):
+        lines.append(label.ljust(index_width) + "".join("  " + values[row].rjust(width) for values, width in zip(columns, widths)))
+    return "\n".join(lines)
+
+def check_tech_assoc_files(manifest, file_list, techniques, missing_files, lane_results=None):
     """ 
-    This function checks the technique and calls appropriate functions.
-    note- the goal of using a techniques file was to not need to have techniques 
-    in variables, but some assumptions no longer hold true so below was implemented.
+    This function checks the files of every technique and aliquot in the techniques file
+    against the technique rules compiled from QC_techniques_master.csv.
     Input: 1) Manifest 
-           2) File list
-           3) Techniquees file.
+           2) Technique rules from get_technique_file_list()
+           3) Techniques file as a DataFrame.
            4) list of missing files.
-    Output: DF with lane and T/F for required and optional files.
+           5) Optional list to append (technique, aliquot, Lane/Req/Opt table from check_techniques()) of every check to.
+    Output: DF with technique, aliquot and PASSED/FAILED for required and optional files.
     """
-    technique = pd.read_csv(techniques, sep=",")
-    total_file_count = len(manifest.filename)
-    data_type = file_list['data_type'].unique()
     master_QA_list = []
-    #All techniques that have R1, R2, I1, and I2 are in the list below. Add to list if new technique fits.
-    raw_4_file_format_techniques = [ "10X Genomics Multiome;RNAseq", "10X Genomics Immune profiling;VDJ",
-     "10X Genomics Immune profilling;GEX", "10xv2", "10xv3", "10xmultiome_cell_hash;RNA"]
-    #All techniques that have R1, R2, R3, I1, and I2 are in the list below. Add to list if new technique fits.
-    raw_5_file_format_techniques =[ "10X Genomics Multiome;ATAC-seq", "10xmultiome_cell_hash;ATAC"]
+    #Count files per aliquot and lane once and check every technique and aliquot from the counts.
+    aliquot_index = build_aliquot_index(manifest)
+    checks = check_techniques(file_list, techniques, summarize_lanes(manifest, missing_files))
     
-    for index, row in technique.iterrows():
-        tname = row['name']
-        aliquot = row['aliquot']
-        logger.info(f"Checking Files for {tname} and Aliquot {aliquot}")
-        
-        #Get all manifest info for technique aliquot
-        man_files = manifest[manifest['filename'].str.contains(aliquot)]
-
-        #Currently only supporting raw file types. 
-        #Checking to see which case the technique belongs to and preoceeding accordingly.
-        if data_type == 'raw' and tname in raw_4_file_format_techniques:
-            check_raw_files = check_raw_4_file_format_techniques(file_list, man_files, aliquot, missing_files)
-            #for overall QA log return Opt and req along with tech and aliquot
-            print("Starting QA for ",tname," aliquot ", aliquot)
-            overall_opt, overall_req = check_QA_for_aliquot(check_raw_files)
-            print(check_raw_files)
-            if check_raw_files['Req'].all() == True and check_raw_files['Opt'].all() == True:
-                logger.info(f"All Required AND Optional Files for {tname} and Aliquot {aliquot} are present")
-                print("QA passed for ",tname," aliquot ", aliquot)
-            elif check_raw_files['Req'].all() == True and check_raw_files['Opt'].any() == False:
-                logger.info(f"All Required Files for {tname} and Aliquot {aliquot} are present. Optional files are either absent of failed QA.")
-                print("QA passed for Required files for ",tname," aliquot ", aliquot)
-            elif check_raw_files['Req'].all() == True and check_raw_files['Opt'].any() == None:
-                logger.info(f"All Required Files for {tname} and Aliquot {aliquot} are present. Optional files are either absent.")
-                print("QA passed for Required files for ",tname," aliquot ", aliquot)
-            else:
-                missing_lanes = check_raw_files[check_raw_files.eq(False).any(1)]["Lane"]
-                logger.error(f"All Required Files for {tname} and Aliquot {aliquot} are NOT present for following lanes %s ",",".join(map(str,missing_lanes)))
-                #logger.error(f"All Required Files for {tname} and Aliquot {aliquot} are NOT present!")
-                print("QA FAILED for ",tname," aliquot ", aliquot)
-            master_QA_list.append([tname, aliquot,overall_opt, overall_req ])
-
-        elif data_type == 'raw' and tname in raw_5_file_format_techniques:
-            #needs testing
-            check_raw_files = check_raw_5_file_format_techniques(file_list, man_files, aliquot, missing_files)
-            print("Starting QA for ",tname," aliquot ", aliquot)
-            #No optional files, find better solution check_QA_for_aliquot
-            overall_opt, overall_req = check_QA_for_aliquot(check_raw_files)
-            print(check_raw_files)
-            if check_raw_files['Req'].all():
-                logger.info(f"All Required Files for {tname} and Aliquot {aliquot} are present")
-                print("QA passed for ",tname," aliquot ", aliquot)
-            else:
-                logger.error(f"All Required Files for {tname} and Aliquot {aliquot} are NOT present!")
-                print("QA FAILED for ",tname," aliquot ", aliquot)
-            #No optional files for these right now.
-            #if check_raw_files['Opt'].all():
-            #    logger.info(f"All Optional Files for {tname} and Aliquot {aliquot} are present")
-            #else:
-            #    logger.warning(f"All Optional Files for {tname} and Aliquot {aliquot} are NOT present!")
-            master_QA_list.append([tname, aliquot,overall_opt, overall_req ])
-
-        elif data_type == 'raw' and tname == "10xmultiome_cell_hash;hashing":
-            #needs testing
-            check_raw_files = check_raw_3_hash_file_format_techniques(file_list, man_files, aliquot, missing_files)
-            print("Starting QA for ",tname," aliquot ", aliquot)
-            print(check_raw_files)
-            if check_raw_files['Req'].all():
-                logger.info(f"All Required Files for {tname} and Aliquot {aliquot} are present")
-                print("QA passed for ",tname," aliquot ", aliquot)
-            else:
-                logger.error(f"All Required Files for {tname} and Aliquot {aliquot} are NOT present!")
-                print("QA FAILED for ",tname," aliquot ", aliquot)
-            if check_raw_files['Opt'].all():
-                logger.info(f"All Optional Files for {tname} and Aliquot {aliquot} are present")
-            else:
-                logger.warning(f"All Optional Files for {tname} and Aliquot {aliquot} are NOT present!")
+    for tname, aliquot, check_raw_files in zip(techniques['name'], techniques['aliquot'], checks):
+        logger.info("Checking Files for %s and Aliquot %s", tname, aliquot, extra=PER_FILE)
+        if aliquot not in aliquot_index:
+            logger.error(f"No files were found in the manifest for aliquot {aliquot}")
+        else:
+            logger.info("Found %d files in the manifest for aliquot %s", len(aliquot_index[aliquot]), aliquot, extra=PER_FILE)
+
+        if tname not in file_list:
+            print(f"Technique {tname} is not in {TECHNIQUES_MASTER}")
+            master_QA_list.append([tname, aliquot, None, "FAILED"])
+            continue
+        if lane_results is not None:
+            lane_results.append((tname, aliquot, check_raw_files))
+        #for overall QA log return Opt and req along with tech and aliquot
+        print("Starting QA for ",tname," aliquot ", aliquot)
+        overall_opt, overall_req = check_QA_for_aliquot(check_raw_files)
+        print(format_lane_results(check_raw_files))
+        if overall_req == "PASSED" and overall_opt == "PASSED" and any(value is not None for value in check_raw_files['Opt']):
+            logger.info("All Required AND Optional Files for %s and Aliquot %s are present", tname, aliquot, extra=PER_FILE)
+            print("QA passed for ",tname," aliquot ", aliquot)
+        elif overall_req == "PASSED":
+            logger.info("All Required Files for %s and Aliquot %s are present. Optional files are either absent or failed QA.", tname, aliquot, extra=PER_FILE)
+            print("QA passed for Required files for ",tname," aliquot ", aliquot)
         else:
-            print("files are not raw or in 4 format raw")
-        master_QA_df = pd.DataFrame(master_QA_list, columns = ['Technique','Aliquot','Optional', 'Required'])
+            missing_lanes = [lane for lane, req in zip(check_raw_files['Lane'], check_raw_files['Req']) if not req]
+            logger.error("All Required Files for %s and Aliquot %s are NOT present for following lanes %s ", tname, aliquot, ",".join(map(str,missing_lanes)))
+            print("QA FAILED for ",tname," aliquot ", aliquot)
+        master_QA_list.append([tname, aliquot,overall_opt, overall_req ])
         print("-------------")
-    return master_QA_df
+    return pd.DataFrame(master_QA_list, columns = ['Technique','Aliquot','Optional', 'Required'])
+
+def add_fastq_results(file_checks, md5sums_df, manifest):
+    """
+    Add per aliquot FASTQ record counts and validation verdicts to the results table.
+
+    Parameters:
+    file_checks (pandas.DataFrame): Results table with an Aliquot column.
+    md5sums_df (pandas.DataFrame): Checksum results with fastq_records and fastq_error columns.
+    manifest (pandas.DataFrame): Manifest with library_aliquot_name, in the same order as md5sums_df.
+
+    Returns:
+    bool: False if any gzipped FASTQ failed validation, True otherwise.
+    """
+    fastq = md5sums_df[md5sums_df['manifest_filename'].astype(str).str.endswith(FASTQ_GZ_EXTENSIONS)].copy()
+    fastq['aliquot'] = aliquot_keys(manifest).loc[fastq.index]
+    fastq['failed'] = fastq['fastq_error'].notna() | fastq['fastq_records'].isna()
+    for index, row in fastq[fastq['failed']].iterrows():
+        logger.error("FASTQ validation failed for %s: %s", row['manifest_filename'], row['fastq_error'])
+    records = fastq.groupby('aliquot')['fastq_records'].sum().astype('Int64')
+    failed = fastq.groupby('aliquot')['failed'].any()
+    file_checks["FastqRecords"] = file_checks["Aliquot"].map(records)
+    file_checks["FastqQA"] = file_checks["Aliquot"].map(failed).map({True: "FAILED", False: "PASSED"})
+    return not fastq['failed'].any()
 
 def check_QA_for_aliquot(check_raw_files):
     req = None
     opt = None
     #print("***")
     #print(check_raw_files)
-    if 'Opt' in check_raw_files.columns:
-        if (check_raw_files['Opt']).eq(False).any():
+    if 'Opt' in check_raw_files:
+        optional = list(check_raw_files['Opt'])
+        #None means no optional files in that lane, it neither passes nor fails the aliquot
+        if any(value is not None and not value for value in optional):
             opt = "FAILED"
-        elif (check_raw_files['Opt']).eq(True).all():
-            opt = "PASSED"
-        elif (check_raw_files['Opt']).eq(None).any() and not (check_raw_files['Opt']).eq(False).any():
+        elif all(value is not None and value for value in optional):
             opt = "PASSED"
     else:
         opt = None
-    if not check_raw_files['Req'].all():
+    if not all(check_raw_files['Req']):
         req = "FAILED"
     else:
         req = "PASSED"
     return opt,req
 
-def get_technique_file_list(techniques, master):
-    technique = pd.read_csv(techniques, sep=",")
-    #print(technique)
-    file_list = master[master.technique.isin(technique.name)]
-    #temporary prints for new users. Will be replaced with logging.
-    #print(" Step 3 Complete: Getting technique details")
+def get_technique_file_list(techniques, rules):
+    """
+    Rules from the compiled techniques master for the techniques in the user's techniques file.
+
+    Parameters:
+    techniques (pandas.DataFrame): Techniques file with name and aliquot columns.
+    rules (dict): Rules of every technique from load_technique_rules().
+
+    Returns:
+    dict: Technique name to its rules, for the techniques that are in the master.
+    """
+    file_list = {name: rules[name] for name in techniques['name'].unique() if name in rules}
+    for name in techniques['name'].unique():
+        if name not in rules:
+            logger.error(f"Technique {name} is not in {TECHNIQUES_MASTER}")
     logger.info(f"Getting technique details from master file based on user input.")
     return(file_list)
 
-def open_techniques_with_pathlib(file_name):
-   script_dir = Path(__file__).resolve().parent
-   file_path = script_dir / file_name
-   content = pd.read_csv(file_path, sep=",")
-   return content
+def compile_technique_rules(master_path):
+    """
+    Compile the techniques master into rules: for every technique the kinds of files it requires
+    and the kinds it may have, and whether they are checked per lane (raw data) or per aliquot.
+    File formats naming a FASTQ read become the read type in the file name (R1_fastq -> R1,
+    index1_fastq -> I1), any other format (nuc_hash, bed, ...) is used as is, see file_kinds().
+
+    Parameters:
+    master_path (str): Path to QC_techniques_master.csv.
+
+    Returns:
+    dict: Technique name to {"data_type", "per_lane", "required", "optional"}.
+    """
+    rules = {}
+    with open(master_path, newline="", encoding="utf-8-sig") as master_file:
+        for row in csv.DictReader(master_file):
+            technique = rules.setdefault(row['technique'].strip(), {"data_type": row['data_type'].strip(), "required": [], "optional": []})
+            file_format = row['file_format'].strip()
+            level = "optional" if row['Req_vs_Optional'].strip().lower().startswith("opt") else "required"
+            technique[level].append(FILE_FORMAT_KINDS.get(file_format, file_format.lower()))
+    for technique in rules.values():
+        technique["per_lane"] = technique["data_type"] == "raw"
+    return rules
+
+def load_technique_rules(master_path, cache_path=None):
+    """
+    Compiled rules of the techniques master, read from cache_path if it was compiled from
+    the master as it is now (same size and modification time) by this version of the compiler
+    (TECHNIQUE_RULES_FORMAT). Otherwise the master is compiled
+    and, if cache_path is given and writable, saved there for the next run.
+    """
+    stat = os.stat(master_path)
+    source = {"path": os.path.abspath(master_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "format": TECHNIQUE_RULES_FORMAT}
+    if cache_path:
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cached.get("source") == source:
+                return cached["rules"]
+        except (OSError, ValueError):
+            pass
+    rules = compile_technique_rules(master_path)
+    if cache_path:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump({"source": source, "rules": rules}, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            #Read only install, compile every run.
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+    return rules
+
+def scan_submission(dir_path, recursive=False):
+    """
+    List the files of a submission with os.scandir. File types come from the directory entries,
+    so nothing is stat'd and 100k+ entry directories on Lustre list in seconds.
+
+    Parameters:
+    dir_path (str): Directory with the submitted files.
+    recursive (bool): Also list the files in subdirectories.
 
-def check_dir_vs_manifest(all_files, manifest):
+    Returns:
+    tuple: (dict of file name to its path relative to dir_path, set of file names found more than once)
+    """
+    locations = {}
+    duplicates = set()
+    pending = [""]
+    while pending:
+        subdir = pending.pop()
+        with os.scandir(os.path.join(dir_path, subdir)) as entries:
+            for entry in entries:
+                #The rename journal of -r is kept in the submission directory, it is not a submitted file
+                if not subdir and entry.name.startswith(RENAME_JOURNAL_NAME):
+                    continue
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    pending.append(os.path.join(subdir, entry.name))
+                elif entry.is_file():
+                    if entry.name in locations:
+                        duplicates.add(entry.name)
+                    else:
+                        locations[entry.name] = os.path.join(subdir, entry.name)
+    return locations, duplicates
+
+def stat_submission_files(dir_path, locations, names, jobs=1):
+    """
+    Identity (see file_identity()) of the files of a submission. Stats are slow round trips on
+    Lustre, so they are done -j at a time.
+
+    Parameters:
+    dir_path (str): Directory with the submitted files.
+    locations (dict): File name to path relative to dir_path, from scan_submission().
+    names (list): Names of the files to stat.
+    jobs (int): Number of stats in flight.
+
+    Returns:
+    dict: File name to identity, None for files that could not be stat'd.
+    """
+    paths = [dir_path + locations[name] for name in names]
+    if jobs is None or jobs <= 1:
+        return dict(zip(names, map(file_identity, paths)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(names, executor.map(file_identity, paths)))
+
+def nest_rename_paths(renames, dir_path, locations):
+    """
+    Move the old and new paths of a rename plan into the subdirectory each file was found in by
+    scan_submission(), for --recursive. Files are renamed in place.
+    """
+    names = renames['filename'].astype(str).str[len(dir_path):]
+    subdirs = names.map(lambda name: os.path.dirname(locations.get(name, name)))
+    nested = subdirs != ""
+    renames = renames.copy()
+    renames.loc[nested, 'filename'] = dir_path + names[nested].map(lambda name: locations[name])
+    renames.loc[nested, 'updated_filename'] = dir_path + subdirs[nested] + "/" + renames.loc[nested, 'updated_filename'].astype(str).str[len(dir_path):]
+    return renames
+
+def check_dir_vs_manifest(all_files, manifest, duplicates=()):
     """ 
     Check if files in directory and files listed in the manifest match.
     Error: if there are files in manifest missing from the directory.
+    Error: if a file in the manifest was found in more than one subdirectory (--recursive).
     Warning: if there are files in directory not in manifest
-    Inputs: Directory Files and Manifest Files.
+    Inputs: Directory Files, Manifest Files and file names found more than once.
     Outputs: All files in both and missing files.
     """
     ##Flag for logging
     flag = None
+    directory_files = set(all_files)
+    manifest_files = set(manifest['filename'].astype(str))
     #Get all files that are present in directory and in manifest
-    contains_all = [x for x in all_files if x not in manifest.filename]
+    contains_all = [x for x in all_files if x in manifest_files]
     #Get all files that are present in directory and missing in manifest. NBD. Add to log!
-    missing_files_from_manifest = list(set(all_files) - set(manifest.filename))
+    missing_files_from_manifest = list(directory_files - manifest_files)
     if len(missing_files_from_manifest)>0:
-        logger.warning(f"These files are not in manifest but present in the directory: %s ",missing_files_from_manifest)
+        logger.warning("These files are not in manifest but present in the directory: %s ",missing_files_from_manifest)
     #Get all files that are present in manifest and missing in directory. Bad.
-    missing_files = list(set(manifest.filename) - set(all_files))
+    missing_files = list(manifest_files - directory_files)
+    ambiguous_files = list(manifest_files & set(duplicates))
+    if len(ambiguous_files)>0:
+        logger.error("These files are in manifest and found in more than one subdirectory: %s ",ambiguous_files)
     if len(missing_files)>0:
-        logger.error(f"These files are in manifest but missing from the directory: %s ",missing_files)
+        logger.error("These files are in manifest but missing from the directory: %s ",missing_files)
         flag = False
     else:
-        flag = True
+        flag = not ambiguous_files
     #temporary message for debugging
     #print("Step 1 Complete: Checked Names")
     return(contains_all, missing_files, flag)
 
+def check_file_sizes(dir_path, manifest, missing_files, identities=None):
+    """
+    Check that files listed in the manifest are not empty and, if the manifest
+    has a file_size column, that the size on disk matches it.
+
+    Parameters:
+    dir_path (str): Directory with the submitted files.
+    manifest (pandas.DataFrame): Manifest.
+    missing_files (list): Files already reported missing from the directory.
+    identities (dict): Optional file name to identity from stat_submission_files(). Files are stat'd if not given.
+
+    Returns:
+    bool: True if all file sizes are ok, False otherwise.
+    """
+    bad_files = []
+    if identities is None:
+        identities = {name: file_identity(os.path.join(dir_path, name)) for name in manifest['filename'].astype(str)}
+    present = manifest[~manifest['filename'].isin(missing_files)]
+    sizes = present['filename'].astype(str).map(lambda name: identities[name][3] if identities.get(name) else None)
+    for filename in present['filename'][sizes == 0]:
+        logger.error("File %s is empty.", filename)
+        bad_files.append(filename)
+    if 'file_size' in manifest.columns:
+        listed = pd.to_numeric(present['file_size'], errors='coerce')
+        wrong = sizes.notna() & (sizes != 0) & listed.notna() & (listed != sizes)
+        for filename, size, listed_size in zip(present['filename'][wrong], sizes[wrong], listed[wrong]):
+            logger.error("File %s is %d bytes but the manifest lists %d bytes.", filename, size, listed_size)
+            bad_files.append(filename)
+    if len(bad_files) > 0:
+        print("File size QA failed for the following", ",".join(map(str, bad_files)))
+        return False
+    return True
+
 def renaming_manifest_fastq(manifest, QA_flag, dpath):
     manifest_copy = manifest
     #Flag for columns N/O/P check. This will skip the correctly formatted NYGC submission.
     NOP = None
+    #Info files to rename, done together with the FASTQ renames so they share the journal.
+    info_renames = []
     rename_3 = find_rows_with_extensions(manifest,'filename', ['.csv', '.xml'])
     #print(rename_3)
     #Assumption: Only one Flowcell per manifest. Confirmed with Suvvi on 12/06/23
@@ -770,7 +1729,7 @@ def renaming_manifest_fastq(manifest, QA_flag, dpath):
             newp = prepend_path_to_variable(new[0], dpath)
             #print(newp)
             #add renAMING THESE FILES HERE. EASIEST TO HANDLE.
-            rename_info_file(oldp, newp)
+            info_renames.append((oldp, newp))
             
         #O
         if any(flowcell[0] in s for s in rpf):
@@ -784,7 +1743,7 @@ def renaming_manifest_fastq(manifest, QA_flag, dpath):
             manifest_copy['run_parameters_filename'] = hold['run_parameters_filename']
             new = manifest_copy['run_parameters_filename'].unique()
             newp = prepend_path_to_variable(new[0], dpath)
-            rename_info_file(oldp, newp)
+            info_renames.append((oldp, newp))
         #P
         if any(flowcell[0] in s for s in tubf):
             logger.info(f"No changes necessary for top_unknown_barcodes_filename")
@@ -799,61 +1758,74 @@ def renaming_manifest_fastq(manifest, QA_flag, dpath):
             new = manifest_copy['top_unknown_barcodes_filename'].unique()
             newp = prepend_path_to_variable(new[0], dpath)
             #print(newp)
-            rename_info_file(oldp, newp)
-
-    #Split filename into 2 sub strings 
-    split_filenames = split_column_based_on_aliquotname(manifest, 'filename', 'library_aliquot_name')
-
-    #prepend flowcell name
-    appended = prepend_string_to_column(manifest, 'filename_Part2', flowcell[0])
+            info_renames.append((oldp, newp))
 
-    #Deal with 3 non fq files
-    non_fq = find_files_without_extension(manifest_copy, 'filename', '.gz', 'flow_cell_name')
+    #Work out the new file names and the old -> new mapping in a few column operations.
+    manifest_formatted, renaming_df = plan_renames(manifest_copy, flowcell[0], dpath)
 
-    #Make updated filename. 
-    manifest_copy['updated_filename'] = appended['library_aliquot_name'] +"_"+ appended['filename_Part2']
-    
-    #Make df for filename change.
-    renamed_filt = manifest_copy[['filename', 'updated_filename']].copy()
-    renaming_df = renamed_filt.dropna()
-    hold = replace_double_underscore(renaming_df, 'updated_filename')
-    renaming_df.loc[:,'updated_filename']= hold['updated_filename']
-    #print(renaming_df)
-    manifest_copy['filename'] = non_fq['non_fq']
-    updated_names = replace_values_if_contains(manifest_copy, 'filename', 'updated_filename', 'gz')
-        
-    
-    #prepend paths of files to columns
-    hold1 = prepend_directory_path(renaming_df, 'filename', dpath)
-    renaming_df.loc[:,'filename']=hold1['filename']
-    hold1 = replace_double_underscore(renaming_df, 'filename')
-    renaming_df.loc[:,'filename']=hold1['filename']
-
-    hold2 = prepend_directory_path(renaming_df, 'updated_filename', dpath)
-    renaming_df.loc[:,'updated_filename']=hold2['updated_filename']
-    #hold2 = replace_double_underscore(renaming_df, 'updated_filename')
-    #renaming_df['updated_filename']=hold2['updated_filename']
-    #renaming_df['updated_filename'] = replace_double_underscore(renaming_df, 'updated_filename')
-    #print(renaming_df['filename'])
-    #print(renaming_df['updated_filename'])
-    
-
-    manifest_copy.loc[:,'filename'] = updated_names['filename']
-    #drop extra columns
-    manifest_copy.drop(['filename_Part1', 'filename_Part2', 'non_fq', 'updated_filename'], axis=1, inplace=True)
-
-    manifest_temp = replace_double_underscore(manifest_copy, 'filename')
-    manifest_f1 =  delete_values_based_on_string(manifest_temp, 'demultiplex_stats_filename','file_format','run metrics')
-    manifest_f2 =  delete_values_based_on_string(manifest_f1, 'run_parameters_filename','file_format','run metrics')
-    manifest_formatted =  delete_values_based_on_string(manifest_f2, 'top_unknown_barcodes_filename','file_format','run metrics')
     #Save files
-    split_filenames.to_csv('split.csv', sep='\t')
+    manifest_formatted.to_csv('split.csv', sep='\t')
     manifest_formatted.to_csv('updated_manifest.txt', index=False, sep='\t')
     renaming_df.to_csv('updated_filenames.txt', index=False, sep='\t')
     
     #Handle non fastq files
-    
-    return manifest_formatted,renaming_df
+    info_renaming_df = pd.DataFrame(info_renames, columns=['filename', 'updated_filename'])
+    return manifest_formatted,renaming_df,info_renaming_df
+
+def plan_renames(manifest, flowcell, dpath):
+    """
+    Work out the updated manifest and the old -> new file names without row-wise loops.
+    FASTQ files are renamed to <aliquot>_<flowcell>_<rest of name after the aliquot>.
+    Files that are not gzipped get the flowcell prepended if they do not contain it already.
+
+    Parameters:
+    manifest (pandas.DataFrame): Manifest with filename, library_aliquot_name, flow_cell_name and file_format.
+    flowcell (str): Flowcell name of the submission.
+    dpath (str): Directory with the submitted files.
+
+    Returns:
+    tuple: (updated manifest, DataFrame with full old and new paths in filename and updated_filename)
+    """
+    filenames = manifest['filename']
+    #Rest of the file name after the first occurrence of the aliquot name
+    after_aliquot = text_after_first_occurrence(filenames, manifest['library_aliquot_name'].astype(str))
+    updated_filename = manifest['library_aliquot_name'] + "_" + (flowcell + "_" + after_aliquot.astype(str))
+
+    #Old and new paths for renaming
+    renaming_df = pd.DataFrame({'filename': filenames, 'updated_filename': updated_filename}).dropna()
+    renaming_df['updated_filename'] = renaming_df['updated_filename'].str.replace('__', '_', regex=False)
+    renaming_df = prepend_directory_path(renaming_df, 'filename', dpath)
+    renaming_df = replace_double_underscore(renaming_df, 'filename')
+    renaming_df = prepend_directory_path(renaming_df, 'updated_filename', dpath)
+
+    #Non gz files get the flowcell prepended, gz files get the new name.
+    flowcells = manifest['flow_cell_name']
+    prepend_flowcell = ~filenames.str.endswith('.gz') & ~contains_per_row(filenames, flowcells)
+    non_fq = filenames.where(~prepend_flowcell, flowcells + '_' + filenames)
+    new_filenames = non_fq.mask(non_fq.str.contains('gz', na=False), updated_filename)
+
+    updated_manifest = manifest.drop(columns=PARSED_FILENAME_COLUMNS, errors='ignore')
+    updated_manifest['filename'] = new_filenames
+    updated_manifest = replace_double_underscore(updated_manifest, 'filename')
+    for column in ['demultiplex_stats_filename', 'run_parameters_filename', 'top_unknown_barcodes_filename']:
+        updated_manifest = delete_values_based_on_string(updated_manifest, column, 'file_format', 'run metrics')
+    return updated_manifest, renaming_df
+
+def text_after_first_occurrence(strings, separators):
+    """
+    For every row, the part of strings after the first occurrence of that row's separator
+    ('' if it does not occur). Separators differ per aliquot, so a comprehension is faster
+    than a pandas string method per separator.
+    """
+    return pd.Series([str(string).partition(str(separator))[2] for string, separator in zip(strings, separators)],
+                     index=strings.index, dtype=object)
+
+def contains_per_row(strings, substrings):
+    """
+    For every row, whether that row's substring occurs in strings.
+    """
+    return pd.Series([isinstance(string, str) and pd.notna(substring) and str(substring) in string for string, substring in zip(strings, substrings)],
+                     index=strings.index, dtype=bool)
 
 def find_rows_with_extensions(df, column_name, extensions):
     """
@@ -886,43 +1858,236 @@ def delete_values_based_on_string(df, target_column, condition_column, string_to
     df.loc[mask, target_column] = np.nan
     return df
 
-def rename_info_file(old_file_path, new_file_path):
+def rename_journal_path(dir_path):
     """
-    Rename a file from one path to another.
-
-    Args:
-    old_file_path (str): The current file path.
-    new_file_path (str): The new file path.
-
-    Returns:
-    bool: True if the file was successfully renamed, False otherwise.
+    The rename journal is kept in the submission directory next to the renamed files.
     """
-    try:
-        # Rename the file
-        os.rename(old_file_path, new_file_path)
-        return True
-    except Exception as e:
-        print(f"Error occurred during renaming: {e}")
-        return False
+    return os.path.join(dir_path, RENAME_JOURNAL_NAME)
 
-def rename_files(dataframe, original_column, new_column):
+def rename_files(dataframe, original_column, new_column, journal_path):
     """
-    Renames files based on names in two columns of a DataFrame.
+    Rename files based on names in two columns of a DataFrame as one transaction.
+    The whole plan is validated first and written to a journal, so an interrupted
+    rename can be finished with --resume-rename or undone with --rollback-rename.
 
     Parameters:
     dataframe (pd.DataFrame): The DataFrame containing the file names.
     original_column (str): The name of the column with the original file names.
     new_column (str): The name of the column with the new file names.
+    journal_path (str): Where to write the rename journal.
+
+    Returns:
+    bool: True if every file was renamed, False if nothing or only part of the plan was done.
     """
-    for index, row in dataframe.iterrows():
-        original_name = row[original_column]
-        new_name = row[new_column]
-        
-        # Check if the original file exists and rename it
-        if os.path.exists(original_name):
-            os.rename(original_name, new_name)
-        else:
-            print(f"File {original_name} does not exist.")
+    status = read_rename_journal(journal_path)[1] if os.path.exists(journal_path) else None
+    if status == "planned":
+        print(f"An unfinished rename was found in {journal_path}. Run with --resume-rename or --rollback-rename first.")
+        logger.error(f"Unfinished rename journal {journal_path}, not renaming.")
+        return False
+    pairs = [(old, new) for old, new in zip(dataframe[original_column], dataframe[new_column]) if old != new]
+    #The same file can be listed more than once with the same new name
+    pairs = list(dict.fromkeys(pairs))
+    problems = validate_rename_plan(pairs)
+    if problems:
+        print("Renaming not done, the rename plan has problems:")
+        for problem in problems:
+            print(problem)
+            logger.error(f"Rename plan: {problem}")
+        return False
+    write_rename_journal(journal_path, pairs)
+    logger.info(f"Renaming {len(pairs)} files, journal in {journal_path}")
+    return apply_renames(pairs, journal_path)
+
+def validate_rename_plan(pairs):
+    """
+    Check a list of (old path, new path) renames before touching anything: every source
+    exists and is listed once, no two files get the same name, no new name is already
+    taken or is the source of another rename, and source and target are on the same filesystem.
+
+    Returns:
+    list of str: Problems found. Empty if the plan can be run.
+    """
+    problems = []
+    listings = {}
+    devices = {}
+    def exists(path):
+        directory, name = os.path.split(path)
+        if directory not in listings:
+            try:
+                listings[directory] = set(os.listdir(directory or "."))
+            except OSError:
+                listings[directory] = set()
+        return name in listings[directory]
+    def device(directory):
+        if directory not in devices:
+            try:
+                devices[directory] = os.stat(directory or ".").st_dev
+            except OSError:
+                devices[directory] = None
+        return devices[directory]
+
+    sources = pd.Series([old for old, new in pairs], dtype=object)
+    targets = pd.Series([new for old, new in pairs], dtype=object)
+    for path in sources[sources.duplicated()].unique():
+        problems.append(f"{path} is renamed to more than one new name")
+    for path in targets[targets.duplicated()].unique():
+        problems.append(f"More than one file would be renamed to {path}")
+    source_set = set(sources)
+    for old, new in pairs:
+        if not exists(old):
+            problems.append(f"File {old} does not exist")
+        if new in source_set:
+            problems.append(f"New name {new} is also a file being renamed")
+        elif exists(new):
+            problems.append(f"New name {new} already exists")
+        old_device = device(os.path.dirname(old))
+        if old_device is not None and old_device != device(os.path.dirname(new)):
+            problems.append(f"{old} and {new} are on different filesystems")
+    return problems
+
+def write_rename_journal(journal_path, pairs):
+    """
+    Write the rename plan as JSON lines: a header line with the status and one line per rename.
+    The journal is written to a temporary file, synced and moved into place so it is never partial.
+    """
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, "w") as journal:
+        journal.write(json.dumps({"status": "planned", "created": time.strftime("%Y-%m-%d %H:%M:%S%z"), "renames": len(pairs)}) + "\n")
+        for old, new in pairs:
+            journal.write(json.dumps({"old": os.path.abspath(old), "new": os.path.abspath(new)}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(tmp_path, journal_path)
+    fsync_directory(os.path.dirname(os.path.abspath(journal_path)))
+
+def read_rename_journal(journal_path):
+    """
+    Read a rename journal.
+
+    Returns:
+    tuple: (list of (old path, new path), status) where status is planned, committed or rolled_back.
+    """
+    pairs = []
+    status = None
+    with open(journal_path) as journal:
+        for line in journal:
+            record = json.loads(line)
+            if "status" in record:
+                status = record["status"]
+            else:
+                pairs.append((record["old"], record["new"]))
+    return pairs, status
+
+def mark_rename_journal(journal_path, status):
+    """
+    Append a status line (committed or rolled_back) to the rename journal.
+    """
+    with open(journal_path, "a") as journal:
+        journal.write(json.dumps({"status": status, "at": time.strftime("%Y-%m-%d %H:%M:%S%z")}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+def fsync_directory(directory):
+    """
+    Make renames in directory durable. Not every platform can fsync a directory.
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def apply_renames(pairs, journal_path, status="committed"):
+    """
+    Run renames in bulk relative to open directory file descriptors and fsync each
+    directory once at the end. On an error the renames done so far are kept and the
+    journal stays planned so the rename can be resumed or rolled back.
+
+    Returns:
+    bool: True if all renames were done.
+    """
+    use_dir_fd = os.rename in os.supports_dir_fd
+    dir_fds = {}
+    def dir_fd(directory):
+        if directory not in dir_fds:
+            dir_fds[directory] = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        return dir_fds[directory]
+    done = 0
+    try:
+        for old, new in pairs:
+            if use_dir_fd:
+                old_dir, old_name = os.path.split(old)
+                new_dir, new_name = os.path.split(new)
+                os.rename(old_name, new_name, src_dir_fd=dir_fd(old_dir), dst_dir_fd=dir_fd(new_dir))
+            else:
+                os.rename(old, new)
+            done += 1
+    except OSError as err:
+        print(f"Error occurred during renaming after {done} of {len(pairs)} files: {err}")
+        print(f"Run with --resume-rename to finish or --rollback-rename to undo (journal {journal_path}).")
+        logger.error(f"Renaming stopped after {done} of {len(pairs)} files: {err}")
+        return False
+    finally:
+        for fd in dir_fds.values():
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            os.close(fd)
+        if not use_dir_fd:
+            for directory in {os.path.dirname(path) for pair in pairs for path in pair}:
+                fsync_directory(directory)
+    mark_rename_journal(journal_path, status)
+    logger.info(f"Renamed {done} files")
+    return True
+
+def resume_renames(journal_path, rollback=False):
+    """
+    Finish (or with rollback=True undo) the renames recorded in a journal. Each rename is
+    atomic, so whether it was done is read from which of the old and new names exists.
+
+    Returns:
+    bool: True if the directory now matches the finished (or original) plan.
+    """
+    if not os.path.exists(journal_path):
+        print(f"No rename journal found at {journal_path}")
+        return False
+    pairs, status = read_rename_journal(journal_path)
+    wanted = "rolled_back" if rollback else "committed"
+    if status == wanted:
+        print(f"Nothing to do, journal {journal_path} is already {status}.")
+        return True
+    if not rollback and status == "rolled_back":
+        print(f"Journal {journal_path} was rolled back. Run QA with -r to rename again.")
+        return False
+    if rollback:
+        pairs = [(new, old) for old, new in reversed(pairs)]
+    todo = []
+    problems = []
+    for source, target in pairs:
+        source_exists, target_exists = os.path.lexists(source), os.path.lexists(target)
+        if source_exists and target_exists:
+            problems.append(f"Both {source} and {target} exist")
+        elif source_exists:
+            todo.append((source, target))
+        elif not target_exists:
+            problems.append(f"Neither {source} nor {target} exists")
+    if problems:
+        print("Cannot continue from the rename journal:")
+        for problem in problems:
+            print(problem)
+            logger.error(f"Rename journal: {problem}")
+        return False
+    logger.info(f"{'Rolling back' if rollback else 'Resuming'} {len(todo)} of {len(pairs)} renames from {journal_path}")
+    if apply_renames(todo, journal_path, wanted):
+        print(f"{'Rolled back' if rollback else 'Renamed'} {len(todo)} files.")
+        return True
+    return False
 
 def replace_double_underscore(df, column_name):
     """
@@ -950,64 +2115,6 @@ def replace_values_if_contains(df, target_column, replacement_column, string_to_
     df.loc[mask, target_column] = df.loc[mask, replacement_column]
     return df
 
-def find_files_without_extension(df, column_name, excluded_extension,prepend_column ):
-    """
-    Finds all files in the specified DataFrame column that do not have the specified extension.
-
-    :param df: DataFrame containing the file names.
-    :param column_name: Name of the column in the DataFrame containing the file names.
-    :param excluded_extension: The file extension to exclude (e.g., 'txt').
-    :return: A list of file names without the specified extension.
-    """
-    if excluded_extension.startswith('.'):
-        excluded_extension = excluded_extension[1:]
-    def rename_file(row):
-        file_name = row[column_name]
-        if not file_name.endswith('.' + excluded_extension):
-            if(row[prepend_column] in file_name):
-                logger.info(f"No need to prepend")
-            else:
-                return row[prepend_column] + '_' + file_name
-        return file_name
-
-    df.loc[:,'non_fq'] = df.apply(rename_file, axis=1)
-    return df
-
-    return df[df[column_name].apply(lambda x: not x.endswith('.' + excluded_extension))][column_name].tolist()
-
-def split_column_based_on_aliquotname(df, column_to_split, column_with_delimiter):
-    """
-    Split a string in one column into two parts based on a delimiter specified in another column,
-    and place these parts into two separate new columns.
-
-    Parameters:
-    df (pandas.DataFrame): The DataFrame to modify.
-    column_to_split (str): The name of the column with strings to split.
-    column_with_delimiter (str): The name of the column with the delimiter.
-
-    Returns:
-    pandas.DataFrame: The modified DataFrame with two new columns.
-    """
-
-    # Check if the columns exist in the DataFrame
-    if column_to_split not in df.columns or column_with_delimiter not in df.columns:
-        raise ValueError("Specified columns not found in DataFrame")
-
-    # Initialize the new columns
-    df[column_to_split + '_Part1'] = None
-    df[column_to_split + '_Part2'] = None
-
-    # Perform the split and assign to new columns
-    for index, row in df.iterrows():
-        delimiter = str(row[column_with_delimiter])
-        parts = row[column_to_split].split(delimiter, 1)# Split only on the first occurrence
-
-        df.at[index, column_to_split + '_Part1'] = parts[0]
-        df.at[index, column_to_split + '_Part2'] = parts[1] if len(parts) > 1 else ''
-
-    return df
-
-
 def prepend_string_to_column(df, column_name, string_to_prepend):
     """
     Prepend a string to all values in a specified column of a DataFrame.
@@ -1041,14 +2148,8 @@ def prepend_path_to_variable(variable, path_to_append):
     Returns:
     str: The variable with the path appended.
     """
-    # Ensure the path_to_append starts with a '/'
-    if not path_to_append.startswith('/'):
-        path_to_append = '/' + path_to_append
-    if not path_to_append.endswith('/'):
-        path_to_append += '/'
-
-    # Append the path to the variable
-    variable_with_path = path_to_append + variable 
+    # Join like the FASTQ paths of prepend_directory_path, so relative directories stay relative
+    variable_with_path = os.path.join(path_to_append, variable)
 
     return variable_with_path
 
@@ -1074,9 +2175,30 @@ def prepend_directory_path(df, column_name, directory_path):
 
     return df
 
-def match_md5sums_to_manifest(md5sums_df):
+def match_md5sums_to_manifest(md5sums_df, jobs=1, pool="thread", cache=None, verify_cache=False, blocksize=MD5_BLOCKSIZE, algorithms=("md5",), precomputed=None, checkpoint=None, identities=None, scheduler=None, metrics=None):
     """ 
     Generate independent md5sums and check them against those in manifest.
+    Extra digests (e.g. sha256, crc32c) are computed in the same read and
+    added to md5sums_df as calculated_<algorithm> columns.
+
+    Parameters:
+    md5sums_df (pandas.DataFrame): DataFrame with full_path, manifest_filename and manifest_checksum columns.
+    jobs (int): Number of files to checksum in parallel. 1 runs serially.
+    pool (str): "thread" or "process" worker pool to use when jobs > 1.
+    cache (sqlite3.Connection): Optional checksum cache from open_checksum_cache().
+    verify_cache (bool): Recompute every checksum and report cached values that differ.
+    blocksize (int): Read size in bytes used when hashing.
+    algorithms (tuple of str): Digests to compute. md5 is always computed.
+        "fastq" also validates .fastq.gz files and adds fastq_records and fastq_error columns.
+    precomputed (dict): Optional absolute file path to (identity, digests) hashed earlier, by --watch or
+        an interrupted run. Used for files that have not changed since.
+    checkpoint (ChecksumCheckpoint): Optional checkpoint the digests are appended to as each file is done.
+    identities (dict): Optional file path to identity from stat_submission_files(), so files are not stat'd again.
+    scheduler (ReadScheduler): Optional asyncio read scheduler used instead of the worker pool (--pool async).
+    metrics (RunMetrics): Optional, counts the files and bytes hashed and prints progress.
+
+    Returns:
+    bool: True if all checksums match the manifest, False otherwise.
     """
     #calc md5sum for each file and match to corresponding column in manifest.
     logger.debug("In match_md5sums_to_manifest().")
@@ -1084,9 +2206,95 @@ def match_md5sums_to_manifest(md5sums_df):
     ####
     checksums_ok = False
     error_message = "does not match value provided in the manifest"
+    algorithms = tuple(dict.fromkeys(("md5",) + tuple(algorithms)))
+
+    # Look up files that were already hashed in a previous run, or earlier in this one.
+    filepaths = list(dict.fromkeys(md5sums_df['full_path']))
+    identities = dict(identities or {})
+    cached = {}
+    watched = {}
+    #Cache hits, their last_used is updated with the new entries once hashing is done
+    hits = []
+    if cache is not None or precomputed or checkpoint is not None:
+        for filepath in filepaths:
+            if identities.get(filepath) is None:
+                identities[filepath] = file_identity(filepath)
+            digests = None
+            done = precomputed.get(identities[filepath][0]) if precomputed and identities[filepath] else None
+            if done is not None and tuple(done[0]) == identities[filepath]:
+                digests = watched[filepath] = done[1]
+            elif cache is not None:
+                try:
+                    digests = lookup_cached_digests(cache, identities[filepath])
+                except sqlite3.Error as err:
+                    logger.warning("Checksum cache can not be read, computing the remaining checksums: %s", err)
+                    cache = None
+            if digests is not None and all(algorithm in digests for algorithm in algorithms):
+                cached[filepath] = digests
+                if filepath not in watched:
+                    hits.append(identities[filepath])
+        logger.info(f"Found {len(cached)} of {len(filepaths)} checksums in cache ({len(watched)} hashed while watching or before an interruption).")
+    if verify_cache:
+        to_hash = filepaths
+    else:
+        to_hash = [filepath for filepath in filepaths if filepath not in cached]
+
+    # Compute checksum on each submitted file, checkpointing each one as it is done.
+    sizes = {filepath: identity[3] for filepath, identity in identities.items() if identity is not None}
+    progress = None
+    if metrics is not None:
+        metrics.start_hashing(len(to_hash), sum(sizes.get(filepath, 0) for filepath in to_hash))
+        progress = metrics.add_bytes
+
+    def file_done(filepath, digests):
+        if metrics is not None:
+            metrics.add_file()
+        if checkpoint is not None and digests is not None and identities[filepath] is not None and file_identity(filepath) == identities[filepath]:
+            checkpoint.append(identities[filepath], digests)
 
-    # Compute checksum on each submitted file.
-    md5sums_df['calculated_md5sum'] = md5sums_df['full_path'].apply(compute_md5)
+    try:
+        if (jobs is None or jobs <= 1) and scheduler is None:
+            computed = {}
+            for filepath in to_hash:
+                computed[filepath] = compute_digests(filepath, algorithms, blocksize, progress)
+                file_done(filepath, computed[filepath])
+        else:
+            computed = compute_digests_parallel(to_hash, jobs, pool, algorithms, blocksize, file_done, sizes, scheduler, progress)
+    finally:
+        if metrics is not None:
+            metrics.stop_hashing()
+
+    for filepath, digests in computed.items():
+        if digests is None:
+            continue
+        for algorithm, value in cached.get(filepath, {}).items():
+            if algorithm in digests and algorithm != HASH_SECONDS and digests[algorithm] != value:
+                logger.warning("Cached %s %s for %s does not match computed %s %s.", algorithm, value, filepath, algorithm, digests[algorithm])
+    if cache is not None:
+        #Written in one short transaction, so other runs sharing the cache are not locked out while this one hashes
+        store = [(identities[filepath], digests) for filepath, digests in watched.items() if filepath not in computed]
+        #Only cache if the file was not modified while it was being read.
+        store += [(identities[filepath], digests) for filepath, digests in computed.items()
+                  if digests is not None and identities[filepath] is not None and file_identity(filepath) == identities[filepath]]
+        try:
+            with cache:
+                touch_cached_digests(cache, hits)
+                for identity, digests in store:
+                    store_cached_digests(cache, identity, digests)
+        except sqlite3.Error as err:
+            logger.warning("Could not update the checksum cache: %s", err)
+    results = {**cached, **computed}
+    for algorithm in algorithms:
+        if algorithm == "fastq":
+            continue
+        column = 'calculated_md5sum' if algorithm == "md5" else 'calculated_' + algorithm
+        md5sums_df[column] = md5sums_df['full_path'].map(lambda filepath: (results.get(filepath) or {}).get(algorithm))
+    #Only set for files hashed in this run, or before it was interrupted
+    md5sums_df['hash_seconds'] = md5sums_df['full_path'].map(lambda filepath: (results.get(filepath) or {}).get(HASH_SECONDS))
+    if "fastq" in algorithms:
+        fastq_results = md5sums_df['full_path'].map(lambda filepath: (results.get(filepath) or {}).get("fastq"))
+        md5sums_df['fastq_records'] = fastq_results.map(lambda result: result["records"] if result else None)
+        md5sums_df['fastq_error'] = fastq_results.map(lambda result: result["error"] if result else None)
     
     # Create mask to find mismatching observed and expected checksums.
     df_mask = (md5sums_df['calculated_md5sum'] != md5sums_df['manifest_checksum'])
@@ -1100,8 +2308,9 @@ def match_md5sums_to_manifest(md5sums_df):
         # in manifest.
 
         # Create human readable error messages.
-        logger.error(f"Found mismatches match_md5sums_to_manifest(). Filename : %s",",".join(md5sums_df.iloc[rows_mismatched,1]))
-        print("checksum QC failed for the following",",".join(md5sums_df.iloc[rows_mismatched,1]))
+        mismatched = ",".join(md5sums_df.iloc[rows_mismatched,1])
+        logger.error("Found mismatches match_md5sums_to_manifest(). Filename : %s", mismatched)
+        print("checksum QC failed for the following", mismatched)
         ###print(df_mask)
         #send_file_validation_email(errors, submission_id, submitter)
     else:
@@ -1112,45 +2321,907 @@ def match_md5sums_to_manifest(md5sums_df):
     #print("checksums match!")
     return checksums_ok
 
-def compute_md5(filepath):
+def new_hasher(algorithm):
     """
-    Compute md5 checksum for file. Borrowed from AUX.
+    Create a hasher with update() and hexdigest() for an algorithm name.
+    Any hashlib algorithm is supported, plus crc32c when the crc32c package is installed.
+
+    Args:
+    algorithm (str): Algorithm name, e.g. md5, sha256 or crc32c.
+
+    Returns:
+    object: Hasher for the algorithm.
+    """
+    if algorithm == "crc32c":
+        if importlib.util.find_spec("crc32c") is None:
+            raise ValueError("crc32c digests need the crc32c package (pip install crc32c)")
+        return CRC32CHasher()
+    return hashlib.new(algorithm)
+
+class CRC32CHasher:
+    """
+    hashlib style wrapper around the crc32c package.
     """
-    #logger.info(f"Computing md5 of {filepath}")
+    def __init__(self):
+        self.value = 0
 
-    BLOCKSIZE = 65536
-    md5 = None
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+    def hexdigest(self):
+        return format(self.value, '08x')
+
+class FastqGzipValidator:
+    """
+    Stream-decompress a .fastq.gz from the buffers read for the checksum and
+    check gzip member integrity and the 4 line FASTQ record structure.
+    Has the same update() interface as the hashers so it can share the read.
+    """
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(wbits=31)
+        #First byte of the line that continues in the next block, None if the last block ended a line
+        self.pending = None
+        self.lines = 0
+        self.error = None
+        #True once the zero bytes some writers pad the file with after the last member started
+        self.padding = False
+
+    def update(self, data):
+        while data and not self.error:
+            if self.padding:
+                if data.strip(b"\0"):
+                    self.error = f"data after the zero padding at the end of the gzip file, after line {self.lines}"
+                return
+            #Decompressed output of a block that fails is lost, the copy is used to find where it failed
+            decompressor = self.decompressor.copy()
+            try:
+                block = self.decompressor.decompress(data)
+            except zlib.error as err:
+                self.locate_corruption(decompressor, data, err)
+                return
+            self.count_lines(block)
+            data = b""
+            #Concatenated gzip members. Start a new member with the leftover bytes.
+            if self.decompressor.eof and self.decompressor.unused_data:
+                data = self.decompressor.unused_data
+                if data[0] == 0:
+                    self.padding = True
+                else:
+                    self.decompressor = zlib.decompressobj(wbits=31)
+
+    def locate_corruption(self, decompressor, data, err, step=1024):
+        """
+        Decompress data that failed again in 1 KiB steps and then byte by byte within the failing
+        step, counting the lines before the corrupt part.
+        """
+        for start in range(0, len(data), step):
+            piece = data[start:start + step]
+            before = decompressor.copy()
+            try:
+                self.count_lines(decompressor.decompress(piece))
+            except zlib.error as step_err:
+                if step > 1:
+                    self.locate_corruption(before, piece, step_err, 1)
+                else:
+                    self.error = f"corrupt gzip data after line {self.lines}: {step_err}"
+                return
+            if self.error:
+                return
+        self.error = f"corrupt gzip data after line {self.lines}: {err}"
+
+    def count_lines(self, block):
+        """
+        Count the lines ended in block and check the first byte of every header and separator line.
+        Works on the positions of the newlines with numpy, the lines are never split into a list.
+        """
+        if not block:
+            return
+        data = np.frombuffer(block, dtype=np.uint8)
+        newlines = np.flatnonzero(data == NEWLINE)
+        if len(newlines) == 0:
+            if self.pending is None:
+                self.pending = data[0]
+            return
+        #First byte of every line ended in this block. An empty line gets its newline, which fails both checks.
+        first_bytes = data[np.concatenate(([0], newlines[:-1] + 1))]
+        if self.pending is not None:
+            first_bytes[0] = self.pending
+        #Header lines start with @ and separator lines with +
+        first_header = (-self.lines) % 4
+        first_separator = (2 - self.lines) % 4
+        bad_headers = np.flatnonzero(first_bytes[first_header::4] != ord("@")) * 4 + first_header
+        bad_separators = np.flatnonzero(first_bytes[first_separator::4] != ord("+")) * 4 + first_separator
+        if len(bad_headers) or len(bad_separators):
+            #Report the first bad line of the block, counted from 1
+            line = min(bad_headers[:1].tolist() + bad_separators[:1].tolist())
+            kind = "header line without @" if len(bad_headers) and bad_headers[0] == line else "separator line without +"
+            self.error = f"FASTQ {kind} at line {self.lines + line + 1} (record {(self.lines + line) // 4 + 1})"
+        self.lines += len(newlines)
+        self.pending = data[newlines[-1] + 1] if newlines[-1] + 1 < len(data) else None
+
+    def result(self):
+        """
+        Finish validation. Returns dict with the number of records and an error message (None if valid).
+        """
+        if not self.error:
+            if not self.decompressor.eof:
+                self.error = f"truncated gzip file after line {self.lines}"
+            else:
+                if self.pending is not None:
+                    self.count_lines(b"\n")
+                if not self.error and self.lines % 4 != 0:
+                    self.error = f"incomplete FASTQ record, {self.lines} lines"
+        return {"records": self.lines // 4, "error": self.error}
+
+def new_digesters(filepath, algorithms):
+    """
+    Hashers for algorithms, and under "fastq" a FastqGzipValidator if filepath is a gzipped FASTQ.
+    Every block of the file is fed to all of them, see update_digesters().
+    """
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms if algorithm != "fastq"}
+    if "fastq" in algorithms and str(filepath).endswith(FASTQ_GZ_EXTENSIONS):
+        hashers["fastq"] = FastqGzipValidator()
+    return hashers
+
+def update_digesters(hashers, block):
+    for hasher in hashers.values():
+        hasher.update(block)
+
+def finish_digests(filepath, algorithms, hashers, total, elapsed, blocksize):
+    """
+    Digests of a file from the hashers of new_digesters() once all of it was read. Logs the read rate.
+    """
+    digests = {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items() if algorithm != "fastq"}
+    if "fastq" in algorithms:
+        validator = hashers.get("fastq")
+        digests["fastq"] = validator.result() if validator else None
+        if validator and validator.error:
+            logger.error("FASTQ validation failed for %s: %s", filepath, validator.error)
+    digests[HASH_SECONDS] = elapsed
+    rate = total / elapsed if elapsed > 0 else 0
+    logger.info("Computed %s of %s: %d bytes in %.2fs (%.1f MB/s, block size %d)", ",".join(algorithms), filepath, total, elapsed, rate / 1e6, blocksize, extra=PER_FILE)
+    return digests
+
+def compute_digests(filepath, algorithms=("md5",), blocksize=MD5_BLOCKSIZE, progress=None):
+    """
+    Compute several digests of a file in a single read pass.
+    Reads into one preallocated buffer so no new bytes object is created per block,
+    and logs the read rate so the block size can be tuned per storage tier.
+
+    Args:
+    filepath (str): Path to the file.
+    algorithms (tuple of str): Digests to compute, e.g. ("md5", "sha256", "crc32c").
+        "fastq" validates .fastq.gz/.fq.gz files from the same buffers (see FastqGzipValidator).
+    blocksize (int): Read size in bytes.
+    progress (callable): Optional progress(nbytes), called after every block.
+
+    Returns:
+    dict: Mapping of algorithm to hex digest, or None if the file could not be read.
+        The "fastq" entry is the validator result, or None for files that are not gzipped FASTQ.
+    """
+    #logger.info(f"Computing digests of {filepath}")
+
+    digests = None
 
     try:
-        hasher = hashlib.md5()
-        with open(filepath, 'rb') as afile:
-            buf = afile.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = afile.read(BLOCKSIZE)
-        md5 = hasher.hexdigest()
+        hashers = new_digesters(filepath, algorithms)
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        total = 0
+        start = time.perf_counter()
+        with open(filepath, 'rb', buffering=0) as afile:
+            nread = afile.readinto(buf)
+            while nread:
+                chunk = view[:nread]
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+                total += nread
+                if progress is not None:
+                    progress(nread)
+                nread = afile.readinto(buf)
+        digests = finish_digests(filepath, algorithms, hashers, total, time.perf_counter() - start, blocksize)
     except Exception as err:
-        logger.exception(f"Unable to compute MD5 for file {filepath} due to error.", exc_info=True)
+        logger.exception("Unable to compute %s for file %s due to error.", ",".join(algorithms), filepath)
+
+    return digests
 
-    return md5
+def compute_md5(filepath, blocksize=MD5_BLOCKSIZE):
+    """
+    Compute md5 checksum for file. Borrowed from AUX.
+    """
+    digests = compute_digests(filepath, ("md5",), blocksize)
+    return digests["md5"] if digests else None
 
+def file_identity(filepath):
+    """
+    Identity of a file used as the checksum cache key.
 
-def match(s1, s2):
+    Args:
+    filepath (str): Path to the file.
+
+    Returns:
+    tuple: (absolute path, device, inode, size, mtime_ns) or None if the file cannot be stat'd.
     """
-    Check 2 strings and allow for only 1 mismatch.
-    ex. NY-MX12001-1_S1_L007_I1_001.fastq.gz and NY-MX12001-1_S1_L007_I2_001.fastq.gz should be a match
-    So if match == T and I2 in string it should pass.
-    ex. NY-MX12001-1_S1_L007_I1_001.fastq.gz and NY-MX12001-1_S542_L007_I2_001.fastq.gz should not be a match
-    
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return (os.path.abspath(filepath), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def open_history(history_path):
     """
-    ok = False
-    for c1, c2 in zip(s1, s2):
-        if c1 != c2:
-            if ok:
-                return False
-            else:
-                ok = True
-    return ok
+    Open (and create if needed) the SQLite store of the results of every QA run.
+
+    Args:
+    history_path (str): Path to the history database.
+
+    Returns:
+    sqlite3.Connection: Connection to the history store.
+    """
+    history = sqlite3.connect(str(history_path), timeout=60)
+    history.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY, started TEXT, finished TEXT, submission TEXT, dir_path TEXT,
+            manifest_path TEXT, technique_path TEXT, flowcell TEXT, status TEXT, seconds REAL,
+            files_hashed INTEGER, bytes_hashed INTEGER, options TEXT);
+        CREATE TABLE IF NOT EXISTS file_results (
+            run_id INTEGER, filename TEXT, aliquot TEXT, flowcell TEXT, size INTEGER,
+            manifest_checksum TEXT, calculated_checksum TEXT, checksum_ok INTEGER, hash_seconds REAL,
+            fastq_records INTEGER, fastq_error TEXT);
+        CREATE TABLE IF NOT EXISTS aliquot_results (
+            run_id INTEGER, technique TEXT, aliquot TEXT, flowcell TEXT, required TEXT, optional TEXT,
+            missing_files TEXT, size_qa TEXT, checksum_qa TEXT, fastq_qa TEXT);
+        CREATE TABLE IF NOT EXISTS lane_results (
+            run_id INTEGER, technique TEXT, aliquot TEXT, lane TEXT, required INTEGER, optional INTEGER);
+        CREATE INDEX IF NOT EXISTS runs_submission ON runs (submission, started);
+        CREATE INDEX IF NOT EXISTS runs_flowcell ON runs (flowcell);
+        CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+        CREATE INDEX IF NOT EXISTS file_results_run ON file_results (run_id);
+        CREATE INDEX IF NOT EXISTS file_results_aliquot ON file_results (aliquot);
+        CREATE INDEX IF NOT EXISTS file_results_flowcell ON file_results (flowcell);
+        CREATE INDEX IF NOT EXISTS file_results_checksum ON file_results (manifest_checksum);
+        CREATE INDEX IF NOT EXISTS file_results_calculated ON file_results (calculated_checksum);
+        CREATE INDEX IF NOT EXISTS aliquot_results_run ON aliquot_results (run_id);
+        CREATE INDEX IF NOT EXISTS aliquot_results_aliquot ON aliquot_results (aliquot);
+        CREATE INDEX IF NOT EXISTS aliquot_results_flowcell ON aliquot_results (flowcell);
+        CREATE INDEX IF NOT EXISTS lane_results_run ON lane_results (run_id, aliquot);
+    """)
+    #Stores created before SizeQA was a column of the results have no size_qa column.
+    columns = [row[1] for row in history.execute("PRAGMA table_info(aliquot_results)")]
+    if "size_qa" not in columns:
+        history.execute("ALTER TABLE aliquot_results ADD COLUMN size_qa TEXT")
+        history.commit()
+    return history
+
+def record_history(history_path, options, status, metrics, file_checks, results):
+    """
+    Append the results of a QA run to the history store in one transaction.
+
+    Parameters:
+    history_path (str): Path to the history database.
+    options (argparse.Namespace): Options of the run.
+    status (str): PASSED, FAILED or ERROR.
+    metrics (RunMetrics): Timings of the run.
+    file_checks (pandas.DataFrame): Per aliquot results table, or None if QA stopped with an error.
+    results (dict): Intermediate results filled in by qa_submission(): manifest, checksums and lanes.
+
+    Returns:
+    int: run_id of the run in the history store.
+    """
+    summary = metrics.summary()
+    manifest = results.get("manifest")
+    flowcells = manifest['flow_cell_name'].dropna().astype(str).unique() if manifest is not None and 'flow_cell_name' in manifest.columns else []
+    flowcell = flowcells[0] if len(flowcells) == 1 else ";".join(flowcells) or None
+    finished = time.time()
+    history = open_history(history_path)
+    try:
+        with history:
+            run_id = history.execute(
+                "INSERT INTO runs (started, finished, submission, dir_path, manifest_path, technique_path, flowcell, status, seconds, files_hashed, bytes_hashed, options) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(finished - summary["seconds"])), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(finished)),
+                 os.path.basename(os.path.normpath(options.dir_path)), os.path.abspath(options.dir_path), os.path.abspath(options.manifest_path),
+                 os.path.abspath(options.technique), flowcell, status, summary["seconds"], summary["files_hashed"], summary["bytes_hashed"],
+                 json.dumps(vars(options), default=str))).lastrowid
+            checksums = results.get("checksums")
+            if manifest is not None and checksums is not None:
+                files = pd.DataFrame({
+                    "filename": checksums['manifest_filename'].astype(str),
+                    "aliquot": aliquot_keys(manifest).loc[checksums.index],
+                    "flowcell": manifest['flow_cell_name'] if 'flow_cell_name' in manifest.columns else None,
+                    "size": checksums['full_path'].map(results.get("sizes", {})),
+                    "manifest_checksum": checksums['manifest_checksum'],
+                    "calculated_checksum": checksums.get('calculated_md5sum'),
+                    "hash_seconds": checksums.get('hash_seconds'),
+                    "fastq_records": checksums.get('fastq_records'),
+                    "fastq_error": checksums.get('fastq_error')})
+                files['calculated_checksum'] = files['calculated_checksum'].replace("", None)
+                files.insert(6, "checksum_ok", (files['calculated_checksum'] == files['manifest_checksum']).where(files['calculated_checksum'].notna()))
+                history.executemany("INSERT INTO file_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(run_id, *history_values(row)) for row in files.itertuples(index=False)])
+            if file_checks is not None:
+                aliquots = file_checks.reindex(columns=["Technique", "Aliquot", "Required", "Optional", "MissingFiles", "SizeQA", "CheckSumQA", "FastqQA"])
+                history.executemany("INSERT INTO aliquot_results (run_id, technique, aliquot, flowcell, required, optional, missing_files, size_qa, checksum_qa, fastq_qa) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(run_id, technique, aliquot, flowcell, *history_values(rest)) for technique, aliquot, *rest in aliquots.itertuples(index=False)])
+            history.executemany("INSERT INTO lane_results VALUES (?, ?, ?, ?, ?, ?)",
+                                [(run_id, technique, aliquot, *history_values((lane, req, opt)))
+                                 for technique, aliquot, lanes in results.get("lanes", []) for lane, req, opt in zip(lanes["Lane"], lanes["Req"], lanes["Opt"])])
+    finally:
+        history.close()
+    logger.info(f"Results recorded as run {run_id} in {history_path}")
+    return run_id
+
+def history_values(values):
+    """
+    Values of a results row as types SQLite stores: missing values become NULL and numpy numbers and booleans Python ones.
+    """
+    converted = []
+    for value in values:
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            converted.append(None)
+        elif isinstance(value, (bool, np.bool_)):
+            converted.append(int(value))
+        elif isinstance(value, np.generic):
+            converted.append(value.item())
+        else:
+            converted.append(value)
+    return tuple(converted)
+
+def open_checksum_cache(cache_path):
+    """
+    Open (and create if needed) the SQLite checksum cache.
+
+    Args:
+    cache_path (str): Path to the cache database.
+
+    Returns:
+    sqlite3.Connection: Connection to the cache.
+    """
+    cache = sqlite3.connect(str(cache_path), timeout=60)
+    cache.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                     path TEXT, device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,
+                     md5 TEXT, last_used REAL, digests TEXT,
+                     PRIMARY KEY (path, device, inode, size, mtime_ns))""")
+    #Caches created before extra digests were supported have no digests column.
+    columns = [row[1] for row in cache.execute("PRAGMA table_info(checksums)")]
+    if "digests" not in columns:
+        cache.execute("ALTER TABLE checksums ADD COLUMN digests TEXT")
+    cache.execute("CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+    cache.commit()
+    logger.info(f"Using checksum cache {cache_path}")
+    return cache
+
+def lookup_cached_digests(cache, identity):
+    """
+    Look up the digests of a file in the checksum cache.
+
+    Args:
+    cache (sqlite3.Connection): Checksum cache.
+    identity (tuple): File identity from file_identity().
+
+    Returns:
+    dict: Cached digests by algorithm, or None if the file is not cached or has changed since.
+    """
+    if identity is None:
+        return None
+    row = cache.execute("SELECT md5, digests FROM checksums WHERE path=? AND device=? AND inode=? AND size=? AND mtime_ns=?",
+                        identity).fetchone()
+    if row is None:
+        return None
+    digests = json.loads(row[1]) if row[1] else {}
+    digests["md5"] = row[0]
+    return digests
+
+def touch_cached_digests(cache, identities):
+    """
+    Mark cache entries as used now, so prune_checksum_cache() evicts them last. Lookups do not
+    write, so the cache is not locked while files are hashed.
+
+    Args:
+    cache (sqlite3.Connection): Checksum cache.
+    identities (list of tuple): File identities from file_identity() of the cache hits.
+    """
+    now = time.time()
+    cache.executemany("UPDATE checksums SET last_used=? WHERE path=? AND device=? AND inode=? AND size=? AND mtime_ns=?",
+                      [(now,) + tuple(identity) for identity in identities])
+
+def store_cached_digests(cache, identity, digests):
+    """
+    Store the digests of a file in the checksum cache, replacing older entries for the same path.
+
+    Args:
+    cache (sqlite3.Connection): Checksum cache.
+    identity (tuple): File identity from file_identity().
+    digests (dict): Computed digests by algorithm. Must include md5.
+    """
+    extra = {algorithm: value for algorithm, value in digests.items() if algorithm not in ("md5", HASH_SECONDS)}
+    cache.execute("DELETE FROM checksums WHERE path=?", (identity[0],))
+    cache.execute("INSERT INTO checksums (path, device, inode, size, mtime_ns, md5, last_used, digests) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                  identity + (digests["md5"], time.time(), json.dumps(extra)))
+
+def prune_checksum_cache(cache, max_entries):
+    """
+    Evict least recently used entries so the cache holds at most max_entries files.
+
+    Args:
+    cache (sqlite3.Connection): Checksum cache.
+    max_entries (int): Maximum number of entries to keep.
+    """
+    cache.execute("""DELETE FROM checksums WHERE rowid IN (
+                     SELECT rowid FROM checksums ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (max_entries,))
+    cache.commit()
+
+def checksum_checkpoint_path(options):
+    """
+    --checkpoint, or the default checkpoint of the submission in the working directory, named after its manifest.
+    """
+    if options.checkpoint:
+        return options.checkpoint
+    manifest_path = os.path.abspath(options.manifest_path)
+    return CHECKSUM_CHECKPOINT_NAME.format(name=Path(manifest_path).stem,
+                                           key=hashlib.sha1(manifest_path.encode()).hexdigest()[:12])
+
+class ChecksumCheckpoint:
+    """
+    Append-only file of the digests of every file hashed by the running checksum pass, one JSON line
+    per file with its identity from file_identity(). Results survive a grid job that is killed at its
+    wall clock limit or preempted, and --resume reads them back instead of hashing those files again.
+    The first line records the manifest, a checkpoint of another manifest is never resumed from.
+    """
+    def __init__(self, path, manifest_path, resume=False):
+        self.path = path
+        self.manifest_path = os.path.abspath(manifest_path)
+        self.done = {}
+        if resume:
+            problem = self.resume_problem(path, manifest_path)
+            if problem:
+                raise ValueError(problem)
+            self.done = self.read(path)[1]
+        self.file = open(path, "a" if resume else "w")
+        if self.file.tell() == 0:
+            self.file.write(json.dumps({"manifest": self.manifest_path}) + "\n")
+        else:
+            #A run killed while writing leaves a partial last line
+            with open(path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    self.file.write("\n")
+        self.last_sync = time.monotonic()
+
+    @staticmethod
+    def resume_problem(path, manifest_path):
+        """
+        Why the checkpoint at path can not be resumed for manifest_path, or None if it can.
+        """
+        manifest, done = ChecksumCheckpoint.read(path)
+        if manifest is not None and manifest != os.path.abspath(manifest_path):
+            return f"Checkpoint {path} was written for manifest {manifest}, not {os.path.abspath(manifest_path)}. Not resuming from it."
+        if manifest is None and done:
+            return f"Checkpoint {path} does not say which manifest it was written for. Not resuming from it."
+        return None
+
+    @staticmethod
+    def read(path):
+        """
+        Manifest a checkpoint was written for and its digests by absolute file path, as (identity, digests).
+        Lines that are not complete are skipped.
+
+        Returns:
+        tuple: (absolute manifest path or None if the checkpoint does not exist or has no header, dict of digests)
+        """
+        manifest = None
+        done = {}
+        try:
+            checkpoint_file = open(path)
+        except FileNotFoundError:
+            return manifest, done
+        with checkpoint_file:
+            for number, line in enumerate(checkpoint_file):
+                try:
+                    entry = json.loads(line)
+                    if number == 0 and "manifest" in entry:
+                        manifest = entry["manifest"]
+                        continue
+                    done[entry["identity"][0]] = (tuple(entry["identity"]), entry["digests"])
+                except (ValueError, KeyError, TypeError, IndexError):
+                    continue
+        return manifest, done
+
+    def append(self, identity, digests):
+        self.file.write(json.dumps({"identity": identity, "digests": digests}) + "\n")
+        self.file.flush()
+        if time.monotonic() - self.last_sync >= CHECKPOINT_SYNC_INTERVAL:
+            os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def remove(self):
+        """
+        Delete the closed checkpoint once it is no longer needed.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+class RunMetrics:
+    """
+    Wall time of every phase of a QA run and the throughput of the checksum pass. Prints progress
+    lines with an ETA while files are hashed, and is written as JSON or a Prometheus textfile
+    (file name ending in .prom) at the end of the run with --metrics. Every phase is also profiled
+    if a StageProfiler is given.
+    """
+    def __init__(self, progress_interval=60, profiler=None):
+        self.progress_interval = progress_interval
+        self.profiler = profiler
+        self.phases = {}
+        self.phase_name = None
+        self.phase_start = None
+        self.run_start = time.perf_counter()
+        self.status = None
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.hash_start = None
+        self.hash_seconds = 0
+        self.lock = threading.Lock()
+        self.stop_progress = threading.Event()
+        self.progress_thread = None
+
+    def start_phase(self, name):
+        """
+        End the current phase and start timing the next one.
+        """
+        now = time.perf_counter()
+        if self.phase_name is not None:
+            self.phases[self.phase_name] = self.phases.get(self.phase_name, 0) + now - self.phase_start
+        self.phase_name = name
+        #Writing the profile of a phase is not part of either phase
+        if self.profiler is not None:
+            self.profiler.start(name)
+        self.phase_start = time.perf_counter()
+
+    def finish(self, status):
+        self.start_phase(None)
+        self.status = status
+
+    def start_hashing(self, files, nbytes):
+        """
+        Start counting the checksum pass of files totalling nbytes, with progress lines every progress_interval seconds.
+        """
+        self.files_total += files
+        self.bytes_total += nbytes
+        self.hash_start = time.perf_counter()
+        if self.progress_interval and files:
+            self.stop_progress.clear()
+            self.progress_thread = threading.Thread(target=self.print_progress, daemon=True)
+            self.progress_thread.start()
+
+    def add_bytes(self, nbytes):
+        with self.lock:
+            self.bytes_hashed += nbytes
+
+    def add_file(self):
+        with self.lock:
+            self.files_hashed += 1
+
+    def stop_hashing(self):
+        if self.hash_start is not None:
+            self.hash_seconds += time.perf_counter() - self.hash_start
+            self.hash_start = None
+        if self.progress_thread is not None:
+            self.stop_progress.set()
+            self.progress_thread.join()
+            self.progress_thread = None
+
+    def print_progress(self):
+        while not self.stop_progress.wait(self.progress_interval):
+            elapsed = time.perf_counter() - self.hash_start
+            rate = self.bytes_hashed / elapsed if elapsed > 0 else 0
+            eta = format_duration(max(0, self.bytes_total - self.bytes_hashed) / rate) if rate > 0 else "unknown"
+            print(f"Checksum progress: {self.files_hashed}/{self.files_total} files, {self.bytes_hashed / 1e9:.1f}/{self.bytes_total / 1e9:.1f} GB, "
+                  f"{rate / 1e6:.0f} MB/s, {self.files_hashed / elapsed:.1f} files/s, ETA {eta}", flush=True)
+
+    def summary(self):
+        """
+        Metrics of the run as a dictionary.
+        """
+        return {"status": self.status,
+                "seconds": time.perf_counter() - self.run_start,
+                "phases": dict(self.phases),
+                "files_hashed": self.files_hashed,
+                "bytes_hashed": self.bytes_hashed,
+                "hash_seconds": self.hash_seconds,
+                "files_per_second": self.files_hashed / self.hash_seconds if self.hash_seconds else 0,
+                "mb_per_second": self.bytes_hashed / 1e6 / self.hash_seconds if self.hash_seconds else 0}
+
+    def report(self):
+        """
+        One line summary of the phase times and checksum throughput.
+        """
+        summary = self.summary()
+        phases = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in summary["phases"].items())
+        return (f"QA took {summary['seconds']:.1f}s ({phases}). Hashed {summary['files_hashed']} files, "
+                f"{summary['bytes_hashed'] / 1e9:.2f} GB at {summary['mb_per_second']:.0f} MB/s.")
+
+    def write(self, metrics_path):
+        """
+        Write the metrics to metrics_path, in the Prometheus textfile format if it ends in .prom and as JSON otherwise.
+        Written to a temporary file first so collectors never read half a file.
+        """
+        summary = self.summary()
+        if str(metrics_path).endswith(".prom"):
+            lines = ["# HELP qa_phase_seconds Wall time of a phase of the QA run.", "# TYPE qa_phase_seconds gauge"]
+            lines += [f'qa_phase_seconds{{phase="{name}"}} {seconds:.6f}' for name, seconds in summary["phases"].items()]
+            for name, help_text in [("seconds", "Wall time of the QA run."), ("files_hashed", "Files hashed."),
+                                    ("bytes_hashed", "Bytes hashed."), ("hash_seconds", "Wall time of the checksum pass."),
+                                    ("files_per_second", "Files hashed per second."), ("mb_per_second", "MB hashed per second.")]:
+                lines += [f"# HELP qa_{name} {help_text}", f"# TYPE qa_{name} gauge", f"qa_{name} {summary[name]}"]
+            lines += ["# HELP qa_passed 1 if QA passed, 0 if it failed or stopped with an error.", "# TYPE qa_passed gauge",
+                      f"qa_passed {1 if summary['status'] == 'PASSED' else 0}"]
+            text = "\n".join(lines) + "\n"
+        else:
+            text = json.dumps(summary, indent=2) + "\n"
+        tmp_path = f"{metrics_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(text)
+        os.replace(tmp_path, metrics_path)
+
+def format_duration(seconds):
+    """
+    Seconds as H:MM:SS.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+class StageProfiler:
+    """
+    cProfile stats and tracemalloc memory of every phase of a QA run, written to a directory with --profile.
+    For each phase NN_<phase>.prof (pstats/snakeviz), NN_<phase>.tracemalloc (tracemalloc.Snapshot.load)
+    and a NN_<phase>.txt report, plus profile_summary.tsv with the time and peak memory of all phases.
+    cProfile only sees the main thread, time spent in -j worker threads shows up as waiting.
+    """
+    def __init__(self, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.number = 0
+        self.name = None
+        self.profile = None
+        self.start_time = None
+        tracemalloc.start()
+
+    def start(self, name):
+        """
+        Write the profile of the current phase and start profiling phase name (None to only stop).
+        """
+        self.stop()
+        if name is None:
+            return
+        self.number += 1
+        self.name = name
+        #Peak memory per phase, reset_peak() is new in Python 3.9
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.stop()
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        seconds = time.perf_counter() - self.start_time
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        stem = os.path.join(self.profile_dir, f"{self.number:02d}_{self.name}")
+        self.profile.dump_stats(stem + ".prof")
+        snapshot.dump(stem + ".tracemalloc")
+        with open(stem + ".txt", "w") as report:
+            report.write(f"{self.name}: {seconds:.3f}s, peak traced memory {peak / 1e6:.1f} MB, {current / 1e6:.1f} MB at the end\n\n")
+            pstats.Stats(self.profile, stream=report).sort_stats("cumulative").print_stats(40)
+            report.write("Largest allocations still alive at the end of the phase:\n")
+            for statistic in snapshot.statistics("lineno")[:25]:
+                report.write(f"{statistic}\n")
+        self.stages.append((self.number, self.name, seconds, peak))
+        self.profile = None
+
+    def close(self):
+        """
+        Stop profiling and write profile_summary.tsv.
+        """
+        self.stop()
+        tracemalloc.stop()
+        with open(os.path.join(self.profile_dir, "profile_summary.tsv"), "w") as summary:
+            summary.write("number\tphase\tseconds\tpeak_mb\n")
+            for number, name, seconds, peak in self.stages:
+                summary.write(f"{number}\t{name}\t{seconds:.6f}\t{peak / 1e6:.3f}\n")
+
+class ReadScheduler:
+    """
+    Reads the files of the checksum and FASTQ validation pass from asyncio, so how hard every
+    filesystem is hit can be controlled. At most mount_jobs files are read at once per filesystem
+    (mount_limits overrides it per mount) and jobs in total, every file is read up to read_ahead
+    blocks ahead of hashing, and all reads together can be capped at max_read_mbps.
+    Blocking reads and hashing run in a thread pool, hashlib and zlib release the GIL.
+    """
+    def __init__(self, jobs, mount_jobs=None, mount_limits=None, read_ahead=2, max_read_mbps=0):
+        self.jobs = max(1, jobs or 1)
+        self.mount_jobs = max(1, mount_jobs or self.jobs)
+        self.read_ahead = max(1, read_ahead)
+        self.bytes_per_second = max_read_mbps * 1e6 if max_read_mbps else None
+        #Limits are kept by device, every file of a filesystem has the same st_dev
+        self.device_limits = {}
+        for mount, limit in (mount_limits or {}).items():
+            try:
+                self.device_limits[os.stat(mount).st_dev] = max(1, limit)
+            except OSError as err:
+                logger.warning(f"Ignoring read limit for {mount}: {err}")
+        self.directory_devices = {}
+        self.next_read = 0
+
+    def filesystem(self, filepath):
+        """
+        Device of the filesystem of filepath, looked up once per directory.
+        """
+        directory = os.path.dirname(filepath)
+        if directory not in self.directory_devices:
+            try:
+                self.directory_devices[directory] = os.stat(directory or ".").st_dev
+            except OSError:
+                self.directory_devices[directory] = None
+        return self.directory_devices[directory]
+
+    async def throttle(self, nbytes):
+        """
+        Charge nbytes that were just read, waiting until reading them fits in max_read_mbps.
+        """
+        if self.bytes_per_second is None:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_read)
+        self.next_read = start + nbytes / self.bytes_per_second
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def run(self, filepaths, algorithms=("md5",), blocksize=MD5_BLOCKSIZE, on_done=None, progress=None):
+        """
+        Compute digests of filepaths, started in the given order. progress(nbytes) is called after every block.
+
+        Returns:
+        dict: Mapping of file path to digests (None if they could not be computed), as compute_digests_parallel().
+        """
+        return asyncio.run(self.read_all(filepaths, algorithms, blocksize, on_done, progress))
+
+    async def read_all(self, filepaths, algorithms, blocksize, on_done, progress):
+        loop = asyncio.get_running_loop()
+        #One thread reading and one hashing for every file in flight
+        threads = concurrent.futures.ThreadPoolExecutor(max_workers=2 * self.jobs)
+        overall = asyncio.Semaphore(self.jobs)
+        limits = {}
+        results = {}
+        self.next_read = time.monotonic()
+
+        async def digest(filepath):
+            device = self.filesystem(filepath)
+            if device not in limits:
+                limits[device] = asyncio.Semaphore(self.device_limits.get(device, self.mount_jobs))
+            async with limits[device], overall:
+                results[filepath] = await self.read_file(filepath, algorithms, blocksize, loop, threads, progress)
+            if on_done is not None:
+                on_done(filepath, results[filepath])
+
+        try:
+            await asyncio.gather(*(digest(filepath) for filepath in filepaths))
+        finally:
+            threads.shutdown()
+        return results
+
+    async def read_file(self, filepath, algorithms, blocksize, loop, threads, progress=None):
+        """
+        Digests of one file, reading ahead into a queue of at most read_ahead blocks while the previous blocks are hashed.
+        """
+        blocks = asyncio.Queue(maxsize=self.read_ahead)
+        failure = []
+
+        async def read():
+            try:
+                with open(filepath, 'rb', buffering=0) as afile:
+                    while True:
+                        block = await loop.run_in_executor(threads, afile.read, blocksize)
+                        #Short and empty reads at the end of a file only cost what they read
+                        await self.throttle(len(block))
+                        await blocks.put(block)
+                        if not block:
+                            return
+            except Exception as err:
+                failure.append(err)
+                await blocks.put(None)
+
+        try:
+            hashers = new_digesters(filepath, algorithms)
+            total = 0
+            start = time.perf_counter()
+            reader = asyncio.ensure_future(read())
+            try:
+                while True:
+                    block = await blocks.get()
+                    if block is None:
+                        raise failure[0]
+                    if not block:
+                        break
+                    await loop.run_in_executor(threads, update_digesters, hashers, block)
+                    total += len(block)
+                    if progress is not None:
+                        progress(len(block))
+            finally:
+                reader.cancel()
+            return finish_digests(filepath, algorithms, hashers, total, time.perf_counter() - start, blocksize)
+        except Exception:
+            logger.exception("Unable to compute %s for file %s due to error.", ",".join(algorithms), filepath)
+            return None
+
+def compute_digests_parallel(filepaths, jobs, pool="thread", algorithms=("md5",), blocksize=MD5_BLOCKSIZE, on_done=None, sizes=None, scheduler=None, progress=None):
+    """
+    Compute digests for several files at once using a worker pool.
+    Files are submitted largest first so the slowest file does not start last.
+
+    Parameters:
+    filepaths (list of str): Paths of files to checksum.
+    jobs (int): Number of workers.
+    pool (str): "thread" or "process".
+    algorithms (tuple of str): Digests to compute.
+    blocksize (int): Read size in bytes used when hashing.
+    on_done (callable): Optional on_done(filepath, digests), called as each file finishes.
+    sizes (dict): Optional file sizes already known, so those files are not stat'd again.
+    scheduler (ReadScheduler): Optional, read the files through the asyncio read scheduler instead of a worker pool.
+    progress (callable): Optional progress(nbytes) as files are read. Per block, except with the process
+        pool where it is called with the size of every file as it finishes.
+
+    Returns:
+    dict: Mapping of file path to digests (None if they could not be computed).
+    """
+    def file_size(filepath):
+        if sizes and filepath in sizes:
+            return sizes[filepath]
+        try:
+            return os.path.getsize(filepath)
+        except OSError:
+            return 0
+
+    unique_paths = list(dict.fromkeys(filepaths))
+    ordered = sorted(unique_paths, key=file_size, reverse=True)
+    if scheduler is not None:
+        logger.info(f"Computing checksums for {len(ordered)} files, {scheduler.jobs} at a time and {scheduler.mount_jobs} per filesystem.")
+        return scheduler.run(ordered, algorithms, blocksize, on_done, progress)
+    logger.info(f"Computing checksums for {len(ordered)} files with {jobs} {pool} workers.")
+    executor_class = concurrent.futures.ProcessPoolExecutor if pool == "process" else concurrent.futures.ThreadPoolExecutor
+    #Callbacks can not be sent to other processes
+    block_progress = progress if pool != "process" else None
+    #Worker processes send their log records back to the detailed log of this run
+    worker_logs = log_pipeline.listen_to_workers() if pool == "process" and log_pipeline is not None else None
+    executor_options = {"initializer": log_to_queue, "initargs": (worker_logs.queue,)} if worker_logs is not None else {}
+    try:
+        with executor_class(max_workers=jobs, **executor_options) as executor:
+            futures = {executor.submit(compute_digests, filepath, algorithms, blocksize, block_progress): filepath for filepath in ordered}
+            results = {}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                if progress is not None and block_progress is None:
+                    progress(file_size(futures[future]))
+                if on_done is not None:
+                    on_done(futures[future], results[futures[future]])
+            return {filepath: results[filepath] for filepath in ordered}
+    finally:
+        if worker_logs is not None:
+            worker_logs.stop()
+
 
 if __name__ == '__main__':
     main()
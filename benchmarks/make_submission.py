@@ -0,0 +1,136 @@
+"""
+make_submission.py - Generate a synthetic submission for benchmarking QA.py.
+
+Writes a submission directory of gzipped FASTQ files named like
+<aliquot>_S1_L00N_R1_001.fastq.gz, the run metrics csv/xml files, a manifest TSV
+with their checksums, flow_cell_name and library_aliquot_name, and a techniques CSV.
+FASTQ files are valid gzip and FASTQ (concatenated gzip members), so they also pass
+--validate-fastq, and every file has its own checksum.
+
+Usage:
+python benchmarks/make_submission.py --out DIR [--files N | --aliquots N] [--lanes N] [--reads R1,R2,I1,I2] [--file-size BYTES]
+"""
+
+import argparse
+import gzip
+import hashlib
+import math
+import os
+import random
+
+FLOWCELL = "HBENCH01"
+TECHNIQUE = "10xv3"
+READS = ["R1", "R2", "I1", "I2"]
+INFO_FILES = {"demultiplex_stats_filename": "Demultiplex_Stats.csv",
+              "run_parameters_filename": "RunParameters.xml",
+              "top_unknown_barcodes_filename": "Top_Unknown_Barcodes.csv"}
+MANIFEST_COLUMNS = ["filename", "checksum", "flow_cell_name", "library_aliquot_name", "file_format"] + list(INFO_FILES)
+
+
+def fastq_member(records, seed):
+    """
+    A gzip member with records random 4 line FASTQ records.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for number in range(records):
+        sequence = "".join(rng.choice("ACGT") for _ in range(100))
+        lines.append(f"@r{seed}_{number}\n{sequence}\n+\n{'I' * 100}\n")
+    return gzip.compress("".join(lines).encode(), compresslevel=1, mtime=0)
+
+
+def write_fastq(path, name, size, body):
+    """
+    Write a gzipped FASTQ of about size bytes: a member with a record named after the file,
+    so every file has its own checksum, followed by copies of the body member.
+
+    Returns:
+    str: md5 of the file.
+    """
+    md5 = hashlib.md5()
+    with open(path, "wb") as fastq:
+        head = gzip.compress(f"@{name}\nACGT\n+\nIIII\n".encode(), mtime=0)
+        fastq.write(head)
+        md5.update(head)
+        written = len(head)
+        while written < size:
+            fastq.write(body)
+            md5.update(body)
+            written += len(body)
+    return md5.hexdigest()
+
+
+def make_submission(root, aliquots=1, lanes=1, reads=READS, file_size=64 * 1024, flowcell=FLOWCELL, technique=TECHNIQUE):
+    """
+    Write a synthetic submission to root.
+
+    Parameters:
+    root (str): Directory to write to. The submission goes to root/submission.
+    aliquots (int): Number of aliquots, named NY-BENCH<number>-1.
+    lanes (int): Lanes per aliquot, L001 and up.
+    reads (list of str): Read types of every lane, e.g. ["R1", "R2"].
+    file_size (int): Approximate size of every FASTQ file in bytes.
+    flowcell (str): flow_cell_name of the manifest.
+    technique (str): Technique of every aliquot in the techniques file.
+
+    Returns:
+    tuple: (submission directory with a trailing /, manifest path, techniques path)
+    """
+    submission = os.path.join(root, "submission", "")
+    os.makedirs(submission)
+    body = fastq_member(max(1, min(file_size, 1024 * 1024) // 250), 0)
+    rows = []
+    aliquot_names = [f"NY-BENCH{number:06d}-1" for number in range(1, aliquots + 1)]
+    for aliquot in aliquot_names:
+        for lane in range(1, lanes + 1):
+            for read in reads:
+                name = f"{aliquot}_S1_L{lane:03d}_{read}_001.fastq.gz"
+                checksum = write_fastq(submission + name, name, file_size, body)
+                rows.append([name, checksum, flowcell, aliquot, "fastq"] + list(INFO_FILES.values()))
+    for name in INFO_FILES.values():
+        data = f"{name} of {flowcell}\n".encode()
+        with open(submission + name, "wb") as info:
+            info.write(data)
+        rows.append([name, hashlib.md5(data).hexdigest(), flowcell, aliquot_names[0], "run metrics"] + list(INFO_FILES.values()))
+    manifest = os.path.join(root, "manifest.tsv")
+    with open(manifest, "w") as manifest_file:
+        manifest_file.write("\t".join(MANIFEST_COLUMNS) + "\n")
+        for row in rows:
+            manifest_file.write("\t".join(row) + "\n")
+    techniques = os.path.join(root, "techniques.csv")
+    with open(techniques, "w") as techniques_file:
+        techniques_file.write("name,aliquot\n")
+        for aliquot in aliquot_names:
+            techniques_file.write(f"{technique},{aliquot}\n")
+    return submission, manifest, techniques
+
+
+def aliquots_for_files(files, lanes, reads):
+    """
+    Number of aliquots needed for at least files FASTQ files.
+    """
+    return max(1, math.ceil(files / (lanes * len(reads))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic submission for QA.py")
+    parser.add_argument("--out", dest="out", help="Directory to write the submission, manifest.tsv and techniques.csv to. Must not contain a submission yet.", required=True, metavar="PATH")
+    parser.add_argument("--files", dest="files", help="Number of FASTQ files. Sets --aliquots.", type=int, metavar="N")
+    parser.add_argument("--aliquots", dest="aliquots", help="Number of aliquots. Default is 1.", type=int, default=1, metavar="N")
+    parser.add_argument("--lanes", dest="lanes", help="Lanes per aliquot. Default is 1.", type=int, default=1, metavar="N")
+    parser.add_argument("--reads", dest="reads", help="Comma separated read types of every lane. Default is R1,R2,I1,I2.", default=",".join(READS), metavar="LIST")
+    parser.add_argument("--file-size", dest="file_size", help="Approximate size of every FASTQ file in bytes. Default is 64 KiB.", type=int, default=64 * 1024, metavar="BYTES")
+    parser.add_argument("--flowcell", dest="flowcell", help=f"flow_cell_name of the manifest. Default is {FLOWCELL}.", default=FLOWCELL)
+    parser.add_argument("--technique", dest="technique", help=f"Technique of every aliquot. Default is {TECHNIQUE}.", default=TECHNIQUE)
+    options = parser.parse_args()
+
+    reads = [read.strip() for read in options.reads.split(",") if read.strip()]
+    aliquots = aliquots_for_files(options.files, options.lanes, reads) if options.files else options.aliquots
+    os.makedirs(options.out, exist_ok=True)
+    submission, manifest, techniques = make_submission(options.out, aliquots, options.lanes, reads, options.file_size, options.flowcell, options.technique)
+    print(f"Wrote {aliquots * options.lanes * len(reads)} FASTQ files to {submission}")
+    print(f"python QA.py -d {submission} -m {manifest} -t {techniques}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+stages.py - Time every phase of QA.py at growing submission sizes.
+
+Generates a synthetic submission (see make_submission.py) for every scale, runs
+QA.py on it in a fresh interpreter with --metrics and reports the wall time of every
+phase (manifest, reconcile, technique_checks, checksum, rename_planning, rename,
+output) and the checksum throughput. Use --json to append the results to a file and
+compare runs over time.
+
+Usage:
+python benchmarks/stages.py [--scales 10,100,1000,10000,100000] [--file-size BYTES] [--jobs N] [--rename] [--json FILE] [-- extra QA.py options]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from make_submission import READS, aliquots_for_files, make_submission
+
+QA_SCRIPT = Path(__file__).resolve().parent.parent / "QA.py"
+PHASES = ["manifest", "reconcile", "technique_checks", "checksum", "rename_planning", "rename", "output"]
+LANES = 4
+
+
+def run_scale(files, file_size, jobs, rename, extra_args):
+    """
+    Generate a submission of about files FASTQ files and time QA.py on it.
+
+    Returns:
+    dict: Scale, generated file count, wall time and the metrics written by QA.py.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        aliquots = aliquots_for_files(files, LANES, READS)
+        submission, manifest, techniques = make_submission(root, aliquots, LANES, READS, file_size)
+        metrics_path = os.path.join(root, "metrics.json")
+        command = [sys.executable, str(QA_SCRIPT), "-d", submission, "-m", manifest, "-t", techniques,
+                   "-l", os.path.join(root, "log.txt"), "--no-cache", "--no-history", "-j", str(jobs), "--progress-interval", "0",
+                   "--checkpoint", os.path.join(root, "checkpoint.jsonl"), "--metrics", metrics_path]
+        if rename:
+            command += ["-r", "-u", os.path.join(root, "updated_manifest.tsv")]
+        start = time.perf_counter()
+        subprocess.run(command + extra_args, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        wall = time.perf_counter() - start
+        with open(metrics_path) as metrics_file:
+            metrics = json.load(metrics_file)
+    return {"scale": files, "files": aliquots * LANES * len(READS), "wall": wall, **metrics}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per phase benchmark of QA.py on synthetic submissions")
+    parser.add_argument("--scales", dest="scales", help="Comma separated numbers of FASTQ files. Default is 10,100,1000,10000.", default="10,100,1000,10000", metavar="LIST")
+    parser.add_argument("--file-size", dest="file_size", help="Approximate size of every FASTQ file in bytes. Default is 64 KiB.", type=int, default=64 * 1024, metavar="BYTES")
+    parser.add_argument("--jobs", dest="jobs", help="-j passed to QA.py. Default is 4.", type=int, default=4, metavar="N")
+    parser.add_argument("--rename", dest="rename", help="Flag to also time renaming the files (-r).", action="store_true")
+    parser.add_argument("--json", dest="json_path", help="Append the results as a JSON line to this file.", metavar="FILE")
+    parser.add_argument("extra_args", help="Extra QA.py options after --, e.g. -- --pool async --validate-fastq", nargs="*")
+    options = parser.parse_args()
+
+    results = []
+    print(f"{'files':>7s} {'wall':>8s} " + " ".join(f"{phase:>16s}" for phase in PHASES) + f" {'MB/s':>8s} {'files/s':>9s}")
+    for scale in [int(scale) for scale in options.scales.split(",") if scale.strip()]:
+        result = run_scale(scale, options.file_size, options.jobs, options.rename, options.extra_args)
+        results.append(result)
+        phases = " ".join(f"{result['phases'][phase]:15.3f}s" if phase in result["phases"] else f"{'-':>16s}" for phase in PHASES)
+        print(f"{result['files']:7d} {result['wall']:7.2f}s {phases} {result['mb_per_second']:8.1f} {result['files_per_second']:9.1f}", flush=True)
+
+    if options.json_path:
+        with open(options.json_path, "a") as json_file:
+            json_file.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S%z"), "python": sys.version.split()[0],
+                                        "file_size": options.file_size, "jobs": options.jobs, "rename": options.rename,
+                                        "extra_args": options.extra_args, "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
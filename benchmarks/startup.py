@@ -0,0 +1,65 @@
+"""
+startup.py - Track start up time of QA.py.
+
+Times `python QA.py -h` and a QA run of a minimal submission (one aliquot, one lane,
+R1 and R2) in fresh interpreters, as grid jobs run them. Use --json to append the
+results to a file and follow them over time.
+
+Usage:
+python benchmarks/startup.py [--repeat N] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from make_submission import make_submission
+
+QA_SCRIPT = Path(__file__).resolve().parent.parent / "QA.py"
+
+
+def time_command(command, repeat, cwd):
+    """
+    Wall clock seconds of every run of command.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start up time benchmark for QA.py")
+    parser.add_argument("--repeat", dest="repeat", help="Runs per command. Default is 10.", type=int, default=10, metavar="N")
+    parser.add_argument("--json", dest="json_path", help="Append the results as a JSON line to this file.", metavar="FILE")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        submission, manifest, techniques = make_submission(root, aliquots=1, lanes=1, reads=["R1", "R2"])
+        commands = {
+            "help": [sys.executable, str(QA_SCRIPT), "-h"],
+            "minimal_run": [sys.executable, str(QA_SCRIPT), "-d", submission, "-m", manifest, "-t", techniques,
+                            "-l", os.path.join(root, "log.txt"), "--no-cache", "--no-history"],
+        }
+        results = {}
+        for name, command in commands.items():
+            times = time_command(command, options.repeat, root)
+            results[name] = {"min": min(times), "median": statistics.median(times), "max": max(times)}
+            print(f"{name:12s} min {results[name]['min']:.3f}s  median {results[name]['median']:.3f}s  max {results[name]['max']:.3f}s")
+
+    if options.json_path:
+        with open(options.json_path, "a") as json_file:
+            json_file.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S%z"), "python": sys.version.split()[0],
+                                        "repeat": options.repeat, **results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
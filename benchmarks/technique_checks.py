@@ -0,0 +1,68 @@
+"""
+technique_checks.py - Time the technique and lane checks of QA.py in process.
+
+Builds the manifest of a synthetic submission in memory (no files are written), runs
+check_tech_assoc_files on it for every scale and reports the time taken. 10000 files
+(2500 aliquots of one lane with R1, R2, I1 and I2) should be checked well under a second.
+
+Usage:
+python benchmarks/technique_checks.py [--scales 1000,10000,100000] [--repeat N] [--json FILE]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import QA  # noqa: E402
+
+from make_submission import READS, TECHNIQUE  # noqa: E402
+
+
+def time_scale(files, rules, repeat):
+    """
+    Wall clock seconds of every technique check of a one lane submission of about files FASTQ files.
+    """
+    aliquots = [f"NY-BENCH{number:06d}-1" for number in range(1, max(1, files // len(READS)) + 1)]
+    filenames = [f"{aliquot}_S1_L001_{read}_001.fastq.gz" for aliquot in aliquots for read in READS]
+    manifest = QA.pd.DataFrame({"filename": filenames, "library_aliquot_name": [name.split("_")[0] for name in filenames]})
+    manifest = manifest.join(QA.parse_fastq_filenames(manifest["filename"]))
+    techniques = QA.pd.DataFrame({"name": TECHNIQUE, "aliquot": aliquots})
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            file_checks = QA.check_tech_assoc_files(manifest, QA.get_technique_file_list(techniques, rules), techniques, [], [])
+        times.append(time.perf_counter() - start)
+        if not (file_checks["Required"] == "PASSED").all():
+            raise SystemExit(f"Technique checks of {len(filenames)} files did not pass")
+    return len(filenames), times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Technique and lane check benchmark for QA.py")
+    parser.add_argument("--scales", dest="scales", help="Comma separated numbers of FASTQ files. Default is 1000,10000,100000.", default="1000,10000,100000", metavar="LIST")
+    parser.add_argument("--repeat", dest="repeat", help="Runs per scale. Default is 3.", type=int, default=3, metavar="N")
+    parser.add_argument("--json", dest="json_path", help="Append the results as a JSON line to this file.", metavar="FILE")
+    options = parser.parse_args()
+
+    rules = QA.compile_technique_rules(Path(QA.__file__).resolve().parent / QA.TECHNIQUES_MASTER)
+    results = []
+    for scale in [int(scale) for scale in options.scales.split(",") if scale.strip()]:
+        files, times = time_scale(scale, rules, options.repeat)
+        results.append({"files": files, "min": min(times), "median": statistics.median(times), "max": max(times)})
+        print(f"{files:7d} files  min {min(times):.3f}s  median {statistics.median(times):.3f}s  max {max(times):.3f}s", flush=True)
+
+    if options.json_path:
+        with open(options.json_path, "a") as json_file:
+            json_file.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S%z"), "python": sys.version.split()[0],
+                                        "repeat": options.repeat, "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
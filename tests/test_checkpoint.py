@@ -0,0 +1,69 @@
+import contextlib
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+import QA
+
+sys.path.insert(0, str(Path(QA.__file__).resolve().parent / "benchmarks"))
+from make_submission import make_submission  # noqa: E402
+
+TECHNIQUE_RULES = QA.load_technique_rules(Path(QA.__file__).resolve().parent / QA.TECHNIQUES_MASTER)
+
+
+def test_resume_reads_back_digests_of_the_same_manifest(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    identity = (str(tmp_path / "a.fastq.gz"), 1, 2, 3, 4)
+    checkpoint = QA.ChecksumCheckpoint(path, "manifest.tsv")
+    checkpoint.append(identity, {"md5": "0" * 32})
+    checkpoint.close()
+
+    resumed = QA.ChecksumCheckpoint(path, "manifest.tsv", resume=True)
+    resumed.close()
+
+    assert resumed.done == {identity[0]: (identity, {"md5": "0" * 32})}
+
+
+def test_resume_refuses_a_checkpoint_of_another_manifest(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = QA.ChecksumCheckpoint(path, str(tmp_path / "one" / "manifest.tsv"))
+    checkpoint.append((str(tmp_path / "a.fastq.gz"), 1, 2, 3, 4), {"md5": "0" * 32})
+    checkpoint.close()
+
+    with pytest.raises(ValueError):
+        QA.ChecksumCheckpoint(path, str(tmp_path / "two" / "manifest.tsv"), resume=True)
+
+
+def test_default_checkpoints_differ_per_manifest(tmp_path):
+    options = QA.build_parser().parse_args(["-m", str(tmp_path / "one" / "manifest.tsv")])
+    other = QA.build_parser().parse_args(["-m", str(tmp_path / "two" / "manifest.tsv")])
+
+    assert QA.checksum_checkpoint_path(options) != QA.checksum_checkpoint_path(other)
+
+
+def test_default_checkpoint_is_deleted_after_the_checksum_pass(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    submission, manifest, techniques = make_submission(str(tmp_path))
+    options = QA.build_parser().parse_args(["-d", submission, "-m", manifest, "-t", techniques, "--no-cache", "--no-history", "--progress-interval", "0"])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        QA.run_qa(options, TECHNIQUE_RULES)
+
+    assert not Path(QA.checksum_checkpoint_path(options)).exists()
+    assert list(tmp_path.glob("checksum_checkpoint_*")) == []
+
+
+def test_default_checkpoint_is_kept_when_the_checksum_pass_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    submission, manifest, techniques = make_submission(str(tmp_path))
+    options = QA.build_parser().parse_args(["-d", submission, "-m", manifest, "-t", techniques, "--no-cache", "--no-history", "--progress-interval", "0"])
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(QA, "match_md5sums_to_manifest", interrupted)
+
+    with pytest.raises(KeyboardInterrupt), contextlib.redirect_stdout(io.StringIO()):
+        QA.run_qa(options, TECHNIQUE_RULES)
+
+    assert Path(QA.checksum_checkpoint_path(options)).exists()
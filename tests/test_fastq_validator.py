@@ -0,0 +1,61 @@
+import gzip
+import zlib
+
+import QA
+
+
+RECORD = b"@read\nACGT\n+\nIIII\n"
+
+
+def validate(data, chunk):
+    validator = QA.FastqGzipValidator()
+    compressed = gzip.compress(data)
+    for start in range(0, len(compressed), chunk):
+        validator.update(compressed[start:start + chunk])
+    return validator.result()
+
+
+def test_counts_records_across_block_boundaries():
+    for chunk in (1, 7, 1 << 16):
+        assert validate(RECORD * 1000, chunk) == {"records": 1000, "error": None}
+
+
+def test_reports_header_and_separator_lines():
+    assert "header" in validate(RECORD + b"read\nACGT\n+\nIIII\n", 5)["error"]
+    assert "separator" in validate(RECORD + b"@read\nACGT\n-\nIIII\n", 5)["error"]
+
+
+def test_reports_truncated_and_incomplete_files():
+    assert validate(RECORD + b"@read\nACGT\n", 5)["error"].startswith("incomplete")
+    validator = QA.FastqGzipValidator()
+    validator.update(gzip.compress(RECORD * 10)[:-12])
+    assert validator.result()["error"].startswith("truncated gzip file")
+
+
+def test_reports_the_line_of_the_bad_record():
+    data = RECORD * 1000 + b"@read\nACGT\n-\nIIII\n" + RECORD * 10
+    for chunk in (7, 1 << 16):
+        assert validate(data, chunk)["error"] == "FASTQ separator line without + at line 4003 (record 1001)"
+
+
+def test_accepts_zero_padding_after_the_last_member():
+    compressed = gzip.compress(RECORD * 10) + gzip.compress(RECORD * 5) + b"\0" * 1000
+    for chunk in (1, 7, 1 << 16):
+        validator = QA.FastqGzipValidator()
+        for start in range(0, len(compressed), chunk):
+            validator.update(compressed[start:start + chunk])
+        assert validator.result() == {"records": 15, "error": None}
+
+    validator = QA.FastqGzipValidator()
+    validator.update(gzip.compress(RECORD) + b"\0" * 10 + b"garbage")
+    assert validator.result()["error"].startswith("data after the zero padding")
+
+
+def test_reports_where_the_gzip_data_is_corrupt():
+    #A full flush ends the deflate data of the first 1000 records on a byte boundary, 0xFF then starts an invalid block
+    compressor = zlib.compressobj(wbits=31)
+    compressed = compressor.compress(RECORD * 1000) + compressor.flush(zlib.Z_FULL_FLUSH) + b"\xff" * 64
+    validator = QA.FastqGzipValidator()
+    validator.update(compressed)
+
+    assert validator.result()["error"].startswith("corrupt gzip data after line 4000:")
@@ -0,0 +1,16 @@
+import sys
+
+import pytest
+
+import QA
+
+
+@pytest.mark.parametrize("block_size", ["0", "-1"])
+def test_block_size_must_be_positive(monkeypatch, capsys, block_size):
+    monkeypatch.setattr(sys, "argv", ["QA.py", "-d", "submission", "-m", "manifest.tsv", "-t", "techniques.csv", "-b", block_size])
+
+    with pytest.raises(SystemExit) as exit_info:
+        QA.main()
+
+    assert exit_info.value.code == 2
+    assert "--block-size must be a positive number of bytes" in capsys.readouterr().err
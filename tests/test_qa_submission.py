@@ -0,0 +1,62 @@
+import hashlib
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+import QA
+
+sys.path.insert(0, str(Path(QA.__file__).resolve().parent / "benchmarks"))
+from make_submission import make_submission  # noqa: E402
+
+TECHNIQUE_RULES = QA.load_technique_rules(Path(QA.__file__).resolve().parent / QA.TECHNIQUES_MASTER)
+
+
+def run_qa(tmp_path, submission, manifest, techniques):
+    options = QA.build_parser().parse_args(["-d", submission, "-m", manifest, "-t", techniques, "--no-cache", "--no-history",
+                                            "--checkpoint", str(tmp_path / "checkpoint.jsonl"), "--progress-interval", "0"])
+    return QA.run_qa(options, TECHNIQUE_RULES)
+
+
+def test_empty_file_fails_qa_without_fail_fast(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    submission, manifest_path, techniques = make_submission(str(tmp_path))
+    manifest = pd.read_csv(manifest_path, sep="\t")
+    Path(submission, manifest["filename"].iloc[0]).write_bytes(b"")
+    #The checksum matches, only the size check can catch it
+    manifest.loc[0, "checksum"] = hashlib.md5(b"").hexdigest()
+    manifest.to_csv(manifest_path, sep="\t", index=False)
+
+    file_checks, QA_flag = run_qa(tmp_path, submission, manifest_path, techniques)
+
+    assert QA_flag is False
+    assert file_checks["SizeQA"].tolist() == ["FAILED"]
+    assert file_checks["CheckSumQA"].tolist() == ["PASSED"]
+
+
+def test_complete_submission_passes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    submission, manifest_path, techniques = make_submission(str(tmp_path))
+
+    file_checks, QA_flag = run_qa(tmp_path, submission, manifest_path, techniques)
+
+    assert QA_flag is True
+    assert file_checks["SizeQA"].tolist() == ["PASSED"]
+
+
+def test_rename_with_a_relative_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_submission(".")
+    options = QA.build_parser().parse_args(["-d", "submission/", "-m", "manifest.tsv", "-t", "techniques.csv", "-r", "--no-cache", "--no-history",
+                                            "--checkpoint", "checkpoint.jsonl", "--progress-interval", "0"])
+
+    file_checks, QA_flag = QA.run_qa(options, TECHNIQUE_RULES)
+
+    assert QA_flag is True
+    updated = pd.read_csv("updated_manifest.txt", sep="\t")
+    renamed = set(updated["filename"]) | set(updated["demultiplex_stats_filename"].dropna())
+    assert all(name.startswith("HBENCH01_") or "_HBENCH01_" in name for name in renamed)
+    assert renamed <= set(p.name for p in Path("submission").iterdir())
+    #The journal of the rename is not a submitted file
+    locations, duplicates = QA.scan_submission("submission/")
+    assert QA.RENAME_JOURNAL_NAME not in locations
@@ -0,0 +1,37 @@
+import asyncio
+import hashlib
+import os
+import time
+import types
+
+import pytest
+
+import QA
+
+
+def test_small_files_are_charged_the_bytes_read(tmp_path, monkeypatch):
+    #Files much smaller than the block size must not be charged a full block per read.
+    #The scheduler runs on a fake clock that only moves when it sleeps, so the sleeps it asks for are the throttle.
+    clock = [1000.0]
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        clock[0] += delay
+
+    monkeypatch.setattr(QA, "time", types.SimpleNamespace(**{**vars(time), "monotonic": lambda: clock[0]}))
+    monkeypatch.setattr(QA, "asyncio", types.SimpleNamespace(**{**vars(asyncio), "sleep": sleep}))
+    data = os.urandom(330 * 1000)
+    paths = []
+    for number in range(5):
+        path = tmp_path / f"file{number}.bin"
+        path.write_bytes(data)
+        paths.append(str(path))
+    scheduler = QA.ReadScheduler(2, max_read_mbps=5)
+
+    results = scheduler.run(paths, ("md5",), QA.MD5_BLOCKSIZE)
+
+    assert all(results[path]["md5"] == hashlib.md5(data).hexdigest() for path in paths)
+    #Every read after the first waits for the bytes read before it, the last read of all is the empty one at the end of a file
+    assert sum(sleeps) == pytest.approx(len(data) * len(paths) / 5e6)
+    assert all(delay == pytest.approx(len(data) / 5e6) for delay in sleeps)
@@ -0,0 +1,22 @@
+import pytest
+
+import QA
+
+
+def job_options(tmp_path, *args):
+    options = QA.build_parser().parse_args(["-d", str(tmp_path / "submission"), "-m", str(tmp_path / "manifest.tsv"), "-t", str(tmp_path / "techniques.csv"), *args])
+    return QA.absolute_job_paths(options)
+
+
+def test_job_outputs_inside_batch_out_are_accepted(tmp_path):
+    out_root = tmp_path / "batch_results"
+
+    QA.check_job_outputs(job_options(tmp_path, "-u", str(out_root / "updated_manifest.tsv"), "--metrics", str(out_root / "metrics.json")), str(out_root))
+
+
+@pytest.mark.parametrize("option", ["-u", "--checkpoint", "--metrics", "--cache", "--history"])
+def test_job_outputs_outside_batch_out_are_rejected(tmp_path, option):
+    out_root = tmp_path / "batch_results"
+
+    with pytest.raises(ValueError):
+        QA.check_job_outputs(job_options(tmp_path, option, str(out_root / ".." / "elsewhere" / "file")), str(out_root))
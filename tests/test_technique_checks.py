@@ -0,0 +1,62 @@
+import contextlib
+import io
+import json
+from pathlib import Path
+
+import pandas as pd
+
+import QA
+
+RULES = QA.compile_technique_rules(Path(QA.__file__).resolve().parent / QA.TECHNIQUES_MASTER)
+
+
+def manifest_for(filenames):
+    manifest = pd.DataFrame({"filename": filenames, "library_aliquot_name": [name.split("_")[0] for name in filenames]})
+    return manifest.join(QA.parse_fastq_filenames(manifest["filename"]))
+
+
+def check(filenames, aliquots, missing_files=()):
+    techniques = pd.DataFrame({"name": "10xv3", "aliquot": aliquots})
+    lane_results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        file_checks = QA.check_tech_assoc_files(manifest_for(filenames), QA.get_technique_file_list(techniques, RULES),
+                                                techniques, list(missing_files), lane_results)
+    return file_checks, lane_results
+
+
+def test_lane_missing_a_read_fails_only_its_aliquot():
+    filenames = [f"NY-{aliquot}-1_S1_L00{lane}_{read}_001.fastq.gz" for aliquot in (1, 2) for lane in (1, 2) for read in ("R1", "R2", "I1", "I2")]
+    filenames.remove("NY-2-1_S1_L002_R2_001.fastq.gz")
+
+    file_checks, lane_results = check(filenames, ["NY-1-1", "NY-2-1"])
+
+    assert file_checks["Required"].tolist() == ["PASSED", "FAILED"]
+    assert lane_results[1][2]["Lane"] == ["L001", "L002"]
+    assert lane_results[1][2]["Req"] == [True, False]
+
+
+def test_many_aliquots_are_checked_in_one_pass():
+    aliquots = [f"NY-B{number:06d}-1" for number in range(2500)]
+    filenames = [f"{aliquot}_S1_L001_{read}_001.fastq.gz" for aliquot in aliquots for read in ("R1", "R2", "I1", "I2")]
+    filenames.remove(f"{aliquots[-1]}_S1_L001_R2_001.fastq.gz")
+
+    file_checks, lane_results = check(filenames, aliquots)
+
+    assert (file_checks["Required"][:-1] == "PASSED").all()
+    assert file_checks["Required"].iloc[-1] == "FAILED"
+    assert len(lane_results) == len(aliquots)
+
+
+def test_rules_cache_of_another_format_is_rebuilt(tmp_path, monkeypatch):
+    master = Path(QA.__file__).resolve().parent / QA.TECHNIQUES_MASTER
+    cache = tmp_path / QA.TECHNIQUE_RULES_CACHE
+    QA.load_technique_rules(master, cache)
+    stale = json.loads(cache.read_text())
+    stale["rules"] = {"stale": True}
+    cache.write_text(json.dumps(stale))
+    assert QA.load_technique_rules(master, cache) == {"stale": True}
+
+    monkeypatch.setattr(QA, "TECHNIQUE_RULES_FORMAT", QA.TECHNIQUE_RULES_FORMAT + 1)
+
+    assert QA.load_technique_rules(master, cache) == RULES
+    assert json.loads(cache.read_text())["source"]["format"] == QA.TECHNIQUE_RULES_FORMAT
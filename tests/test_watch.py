@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+import QA
+
+
+def landed(watcher, expected, reads=20):
+    paths = set()
+    for _ in range(reads):
+        names, _ = watcher.read(0.05)
+        paths.update(names)
+        if expected <= paths:
+            break
+    return paths
+
+
+def test_inotify_sees_files_in_new_subdirectories(tmp_path):
+    try:
+        watcher = QA.InotifyWatcher(str(tmp_path), recursive=True)
+    except (OSError, AttributeError):
+        pytest.skip("inotify is not available")
+    try:
+        (tmp_path / "lane1").mkdir()
+        (tmp_path / "lane1" / "a.fastq.gz").write_bytes(b"a")
+        (tmp_path / "lane1" / "nested").mkdir()
+        (tmp_path / "lane1" / "nested" / "b.fastq.gz").write_bytes(b"b")
+        (tmp_path / "c.fastq.gz").write_bytes(b"c")
+        expected = {os.path.join("lane1", "a.fastq.gz"), os.path.join("lane1", "nested", "b.fastq.gz"), "c.fastq.gz"}
+
+        assert landed(watcher, expected) >= expected
+    finally:
+        watcher.close()
+
+
+def test_polling_sees_files_in_subdirectories(tmp_path):
+    watcher = QA.PollingWatcher(str(tmp_path), 0.01, recursive=True)
+    (tmp_path / "lane1").mkdir()
+    (tmp_path / "lane1" / "a.fastq.gz").write_bytes(b"a")
+    (tmp_path / "c.fastq.gz").write_bytes(b"c")
+    expected = {os.path.join("lane1", "a.fastq.gz"), "c.fastq.gz"}
+
+    assert landed(watcher, expected) == expected
+
+
+def test_without_recursive_subdirectories_are_not_watched(tmp_path):
+    watcher = QA.PollingWatcher(str(tmp_path), 0.01)
+    (tmp_path / "lane1").mkdir()
+    (tmp_path / "lane1" / "a.fastq.gz").write_bytes(b"a")
+    (tmp_path / "c.fastq.gz").write_bytes(b"c")
+
+    assert landed(watcher, {"c.fastq.gz", os.path.join("lane1", "a.fastq.gz")}, reads=5) == {"c.fastq.gz"}